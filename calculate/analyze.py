@@ -0,0 +1,34 @@
+"""
+compare methods on combined records without a notebook, summaries are saved as json
+"""
+import argparse
+import json
+
+from whygreedy import pkl_iter
+from whygreedy.analytics import records_to_arrays, compare_methods, bin_column, to_rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare methods on combined records.')
+    parser.add_argument('--records_pkl', dest='records_pkl', type=str, nargs='?',
+                        help='pkl file of combined records', default="mp_oxidation_records.pkl")
+    parser.add_argument('--pairs_pkl', dest='pairs_pkl', type=str, nargs='?',
+                        help='pkl file of pairs, to group by elements and chemical systems', default=None)
+    parser.add_argument('--methods', dest='methods', type=str, nargs=2,
+                        help='compare the first method against the second', default=['lp', 'lazy_f3'])
+    parser.add_argument('--output', dest='output', type=str, nargs='?', default="summary.json")
+
+    args = parser.parse_args()
+    pairs = None if args.pairs_pkl is None else pkl_iter(args.pairs_pkl)
+    arrays = records_to_arrays(pkl_iter(args.records_pkl), pairs)
+    arrays["n_products_bin"] = bin_column(arrays, "n_products", [0, 2, 5, 10, 20, 50, 100, 200, 500])
+    groupings = [None, "n_products_bin"]
+    if pairs is not None:
+        groupings += ["n_elements", "chemsys"]
+    a, b = args.methods
+    summary = dict()
+    for by in groupings:
+        summary[by or "all"] = to_rows(compare_methods(arrays, a, b, by=by))
+    for row in summary["all"]:
+        print("{} vs {}: {}".format(a, b, row))
+    with open(args.output, "w") as f:
+        json.dump(summary, f, indent=2)
@@ -0,0 +1,84 @@
+"""
+compare serialization codecs on data and record files: dump time, load time and file size
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from whygreedy.utils import json_dump, json_load, pkl_dump, pkl_load, file_exists, zstandard, lz4
+
+
+def get_configs(kind: str, threads: int) -> list[dict]:
+    """
+    codec settings to compare, codecs whose package is not installed are skipped
+    """
+    codecs = [None, "gzip"]
+    if zstandard is not None:
+        codecs.append("zstd")
+    if lz4 is not None:
+        codecs.append("lz4")
+    configs = []
+    for codec in codecs:
+        if kind == "json":
+            configs.append(dict(codec=codec))
+        else:
+            configs.append(dict(codec=codec, protocol=4))
+            configs.append(dict(codec=codec, protocol=5, out_of_band=True))
+        if codec == "zstd" and threads != 0:
+            configs.append(dict(configs[-1], threads=threads))
+    return configs
+
+
+def benchmark(o, kind: str, config: dict, folder: str, repeat: int) -> dict:
+    fn = os.path.join(folder, "benchmark.{}".format(kind))
+    dump_times = []
+    load_times = []
+    for _ in range(repeat):
+        ts1 = time.perf_counter()
+        if kind == "json":
+            json_dump(o, fn, **config)
+        else:
+            pkl_dump(o, fn, **config)
+        ts2 = time.perf_counter()
+        if kind == "json":
+            json_load(fn)
+        else:
+            pkl_load(fn)
+        ts3 = time.perf_counter()
+        dump_times.append(ts2 - ts1)
+        load_times.append(ts3 - ts2)
+    return dict(config, dump_seconds=min(dump_times), load_seconds=min(load_times), size_bytes=os.path.getsize(fn))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark serialization codecs.')
+    parser.add_argument('--files', dest='files', type=str, nargs='+',
+                        help='json(.gz) or pkl files to benchmark on',
+                        default=["../data/mp.json.gz", "mp_oxidation_pairs.pkl", "mp_oxidation_records.pkl"])
+    parser.add_argument('--threads', dest='threads', type=int, nargs='?',
+                        help='also try multi-threaded zstd with this many threads, -1 for all cores', default=-1)
+    parser.add_argument('--repeat', dest='repeat', type=int, nargs='?', default=3)
+    parser.add_argument('--output', dest='output', type=str, nargs='?', default="benchmark_codecs.json")
+
+    args = parser.parse_args()
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for fn in args.files:
+            if not file_exists(fn):
+                print("skip missing file: {}".format(fn))
+                continue
+            kind = "json" if ".json" in os.path.basename(fn) else "pkl"
+            o = json_load(fn) if kind == "json" else pkl_load(fn)
+            for config in get_configs(kind, args.threads):
+                result = dict(file=fn, **benchmark(o, kind, config, folder, args.repeat))
+                print(
+                    "{file} {codec} {options}: dump {dump_seconds:.3f} s, load {load_seconds:.3f} s, "
+                    "{size_bytes} bytes".format(
+                        options={k: v for k, v in config.items() if k != "codec"}, **result
+                    )
+                )
+                results.append(result)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,76 @@
+"""
+compare LP with and without pruning products above the hull (`--prune` of calculate.py): wall time of the same pairs
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from whygreedy import pkl_load
+from whygreedy.calculator import Calculator, get_cal_function
+from whygreedy.mp import find_environment_pairs_from_compounds
+from whygreedy.workload import gen_synthetic_pairs, WorkloadProfile
+
+
+def gen_pairs(reaction_type: str, n_pairs: int, products_per_chemsys: float, seed: int) -> list:
+    """
+    synthetic pairs, decomposition pairs are built from a pool of compounds like `load_mp_decomposition_pairs`,
+    so the reactant of a pair is left out of its products
+    """
+    profile = WorkloadProfile.default()
+    profile.products_per_chemsys = products_per_chemsys
+    pairs = []
+    for chunk in gen_synthetic_pairs(n_pairs, seed, for_oxide=reaction_type == "oxidation", profile=profile):
+        pairs += chunk
+    if reaction_type == "oxidation":
+        return pairs
+    compounds = []
+    for reactant, products in pairs:
+        compounds += [reactant] + products
+    compounds = list({c.mpid: c for c in compounds}.values())
+    return find_environment_pairs_from_compounds(compounds, ["decomposition"])["decomposition"][:n_pairs]
+
+
+def benchmark(pairs: list, reaction_type: str, prune: bool, repeat: int) -> dict:
+    cal_function, cal_function_kwargs = get_cal_function("lp", reaction_type)
+    times = []
+    for _ in range(repeat):
+        calculator = Calculator(pairs, "benchmark", cal_function, cal_function_kwargs, prune=prune)
+        ts1 = time.perf_counter()
+        records = calculator.cal_serial()
+        ts2 = time.perf_counter()
+        times.append(ts2 - ts1)
+    result = dict(prune=prune, seconds=min(times), dh=[r["dh"] for r in records])
+    if prune:
+        result.update(calculator.pruner.report())
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark pruning products before LP.')
+    parser.add_argument('--reaction_type', dest='reaction_type', type=str, nargs='?', default='decomposition',
+                        choices=['decomposition', 'oxidation'])
+    parser.add_argument('--pairs_pkl', dest='pairs_pkl', type=str, nargs='?',
+                        help='pkl file of pairs, default synthetic pairs', default=None)
+    parser.add_argument('--n_pairs', dest='n_pairs', type=int, nargs='?', default=2000)
+    parser.add_argument('--products_per_chemsys', dest='products_per_chemsys', type=float, nargs='?',
+                        help='for synthetic pairs, mean number of products in a chemical system', default=6.0)
+    parser.add_argument('--seed', dest='seed', type=int, nargs='?', default=42)
+    parser.add_argument('--repeat', dest='repeat', type=int, nargs='?', default=3)
+    parser.add_argument('--output', dest='output', type=str, nargs='?', default="benchmark_prune.json")
+
+    args = parser.parse_args()
+    if args.pairs_pkl is None:
+        pairs = gen_pairs(args.reaction_type, args.n_pairs, args.products_per_chemsys, args.seed)
+    else:
+        pairs = pkl_load(args.pairs_pkl)[:args.n_pairs]
+    n_products = np.mean([len(products) for _, products in pairs])
+    print("{} {} pairs, {:.1f} products on average".format(len(pairs), args.reaction_type, n_products))
+    results = [benchmark(pairs, args.reaction_type, prune, args.repeat) for prune in [False, True]]
+    assert np.allclose(results[0]["dh"], results[1]["dh"]), "pruning changed delta H"
+    for result in results:
+        print({k: v for k, v in result.items() if k != "dh"})
+    print("speedup: {:.2f}x".format(results[0]["seconds"] / results[1]["seconds"]))
+    with open(args.output, "w") as f:
+        json.dump([{k: v for k, v in result.items() if k != "dh"} for result in results], f, indent=2)
@@ -3,11 +3,13 @@ import inspect
 import logging
 import os
 import time
+from collections import Counter
+from typing import Iterable, Iterator
 
-from whygreedy import pkl_load, pkl_dump
-from whygreedy.algo import find_greedy_first_choices, find_greedy_old_first_choices, find_lp
-from whygreedy.calculator import Calculator
-from whygreedy.utils import file_type, file_exists
+from whygreedy import pkl_load, pkl_iter, pkl_dump_chunks
+from whygreedy.calculator import Calculator, get_cal_function
+from whygreedy.pipeline import prefetch, consume_in_background, chunked
+from whygreedy.utils import file_type, file_exists, load_pairs_meta
 
 
 def get_kwargs():
@@ -20,63 +22,107 @@ def get_kwargs():
     return kwargs
 
 
+def summarize(records: Iterable[dict], summary: dict) -> Iterator[dict]:
+    """
+    pass records through, counting paths, unfinished searches and pruned products in `summary` on the way
+    """
+    for record in records:
+        summary["paths"][record.get("path", "general")] += 1
+        summary["n_unfinished"] += not record.get("finished", True)
+        summary["n_products_before"] += len(record["products"])
+        summary["n_products_after"] += record.get("n_products_kept", len(record["products"]))
+        yield record
+
+
 def compute(
         method: str, records_pkl: file_type,
         pairs_pkl: file_type, firstk: int or None,
-        reaction_type: str, parallel: bool
-):
+        reaction_type: str, parallel: bool, threads: bool = False, fast_path: bool = False,
+        batch_size: int = None, telemetry_file: file_type = None, time_budget: float = None,
+        prune: bool = False, chunk_size: int = 1000, queue_size: int = 4,
+) -> int:
+    """
+    pairs are read, solved and written as a stream: a reader thread unpickles pairs, the calculator solves them,
+    and a writer thread pickles records in chunks of `chunk_size`,
+    at most `queue_size` chunks wait between two stages, so memory does not grow with the number of pairs
+    (a pairs file written by `pkl_dump` is still unpickled at once, one written by `pkl_dump_chunks` is not),
+    the number of pairs and their cost for the progress bar and telemetry come from the sidecar written by
+    `pkl_dump_pairs`, without it there is no total and no ETA,
+    batched LP (`batch_size`) loads all pairs first
+
+    :return: number of records
+    """
     if not file_exists(pairs_pkl):
         raise FileNotFoundError("pairs file not found!")
-    logging.info("loading pairs file: {}".format(pairs_pkl))
-    pairs = pkl_load(pairs_pkl)
 
     if file_exists(records_pkl):
         logging.info("found records file: {}".format(records_pkl))
         logging.info("will not compute anything, just sanity check")
-        records = pkl_load(records_pkl)
-        if len(records) != len(pairs):
-            logging.critical("records has length: {}".format(len(records)))
-            logging.critical("but pairs has length: {}".format(len(pairs)))
-        if not all(isinstance(d, dict) for d in records):
+        n_records = 0
+        n_not_dict = 0
+        for record in pkl_iter(records_pkl):
+            n_records += 1
+            n_not_dict += not isinstance(record, dict)
+        meta = load_pairs_meta(pairs_pkl)
+        n_pairs = sum(1 for _ in pkl_iter(pairs_pkl)) if meta is None else meta["n_pairs"]
+        if n_records != n_pairs:
+            logging.critical("records has length: {}".format(n_records))
+            logging.critical("but pairs has length: {}".format(n_pairs))
+        if n_not_dict > 0:
             logging.critical("some records are not dictionary!")
-        return records
+        return n_records
 
     name = str(get_kwargs())
 
-    cal_function_kwargs = {}
-    if reaction_type == "oxidation":
-        cal_function_kwargs["for_oxide"] = True
-    elif reaction_type == "decomposition":
-        cal_function_kwargs["for_oxide"] = False
-    else:
-        raise ValueError("reaction_type is: {}".format(reaction_type))
-
-    if method == "lazy":
-        cal_function = find_greedy_old_first_choices
-        cal_function_kwargs["firstk"] = firstk
-    elif method == "diligent":
-        cal_function = find_greedy_first_choices
-        cal_function_kwargs["diligent_greedy"] = True
-        cal_function_kwargs["firstk"] = firstk
-    elif method == "lp":
-        cal_function = find_lp
-        cal_function_kwargs = {}  # this does not take any kwarg
-    else:
-        raise ValueError("method is: {}".format(method))
+    cal_function, cal_function_kwargs = get_cal_function(method, reaction_type, firstk, time_budget)
 
     if method == "pmg" and reaction_type == "oxidation":
         raise ValueError("this cannot be done: method=={}, reaction_type=={}".format(method, reaction_type))
 
-    calculator = Calculator(pairs=pairs, name=name, cal_function=cal_function, cal_function_kwargs=cal_function_kwargs)
+    calculator = Calculator(pairs=[], name=name, cal_function=cal_function, cal_function_kwargs=cal_function_kwargs,
+                            fast_path=fast_path, telemetry_file=telemetry_file, telemetry_label=method,
+                            prune=prune)
+    n_jobs = os.cpu_count() if parallel else 1
     ts1 = time.perf_counter()
-    if parallel:
-        records = calculator.cal_parallel(n_jobs=os.cpu_count())
+    logging.info("streaming pairs file: {}".format(pairs_pkl))
+    if batch_size is not None:
+        if method != "lp":
+            raise ValueError("batch_size can only be used with lp, but method is: {}".format(method))
+        calculator.pairs = pkl_load(pairs_pkl)
+        records = iter(calculator.cal_batched(batch_size=batch_size, n_jobs=n_jobs))
+        calculator.pairs = []
     else:
-        records = calculator.cal_serial()
-    pkl_dump(records, records_pkl)
+        meta = load_pairs_meta(pairs_pkl)
+        if meta is None:
+            logging.info("no sidecar for the pairs file, progress has no total and telemetry has no ETA")
+            total = None
+            total_cost = None
+        else:
+            total = meta["n_pairs"]
+            total_cost = sum(calculator.n_products_cost(n) * count for n, count in meta["n_products"].items())
+        pairs = prefetch(pkl_iter(pairs_pkl), maxsize=chunk_size * queue_size)
+        records = calculator.cal_stream(pairs, n_jobs=n_jobs, threads=threads, total=total, total_cost=total_cost)
+    summary = dict(paths=Counter(), n_unfinished=0, n_products_before=0, n_products_after=0)
+    records = summarize(records, summary)
+    # a killed run never leaves a truncated records file behind, which would be taken as done
+    records_pkl_tmp = "{}.tmp".format(records_pkl)
+    n_records = consume_in_background(lambda chunks: pkl_dump_chunks(chunks, records_pkl_tmp),
+                                      chunked(records, chunk_size), maxsize=queue_size)
+    os.replace(records_pkl_tmp, records_pkl)
     ts2 = time.perf_counter()
     logging.critical("time cost: {:.4f} s".format(ts2 - ts1))
-    return records
+    if fast_path:
+        logging.critical("pairs by path: {}".format(dict(summary["paths"])))
+    if prune:
+        n_before = summary["n_products_before"]
+        n_after = summary["n_products_after"]
+        fraction_removed = 1 - n_after / n_before if n_before > 0 else 0.0
+        logging.critical("pruned products: {}".format(
+            dict(n_products_before=n_before, n_products_after=n_after, fraction_removed=fraction_removed)
+        ))
+    if time_budget is not None:
+        logging.critical("pairs out of time: {}".format(summary["n_unfinished"]))
+    return n_records
 
 
 if __name__ == '__main__':
@@ -86,22 +132,52 @@ if __name__ == '__main__':
     parser.add_argument('--pairs_pkl', dest='pairs_pkl', metavar='pairs_pkl', type=str, nargs='?',
                         help='existing pkl file for `pairs` describing reactions', default="mp_decomp_pairs.pkl")
     parser.add_argument('--reaction_type', dest='reaction_type', metavar='reaction_type', type=str, nargs='?',
-                        help='oxidation, decomposition', default='decomposition')
+                        help='oxidation, decomposition, nitridation, hydration, carbonation',
+                        default='decomposition')
     parser.add_argument('--method', dest='method', type=str, nargs='?',
                         help='method for minimizing delta H', default='lp',
                         choices=['lazy', 'diligent', 'lp', 'pmg'])
     parser.add_argument('--firstk', dest='firstk', type=int, nargs='?',
                         help='how many different first choices to try in a greedy algorithm, default all choices',
                         default=None, )
+    parser.add_argument('--time_budget', dest='time_budget', type=float, nargs='?',
+                        help='for a greedy algorithm, seconds allowed for trying first choices of a pair, '
+                             'the best solution found in time is kept, default no limit',
+                        default=None, )
+    parser.add_argument('--batch_size', dest='batch_size', type=int, nargs='?',
+                        help='for lp, solve this many pairs in one block-diagonal LP, default one pair per LP',
+                        default=None, )
+    parser.add_argument('--telemetry_file', dest='telemetry_file', type=str, nargs='?',
+                        help='write live metrics to this file, Prometheus text if it ends with .prom, '
+                             'otherwise JSON lines', default=None, )
+    parser.add_argument('--chunk_size', dest='chunk_size', type=int, nargs='?',
+                        help='records are written in chunks of this many', default=1000, )
+    parser.add_argument('--queue_size', dest='queue_size', type=int, nargs='?',
+                        help='max number of chunks waiting between reading, solving and writing', default=4, )
     parser.add_argument('--parallel', action='store_true')
+    parser.add_argument('--threads', action='store_true',
+                        help='use a thread pool instead of processes when running in parallel')
+    parser.add_argument('--prune', action='store_true',
+                        help='for lp, remove products above the lower hull of their chemical system before solving, '
+                             'pays off when pairs share many products, see benchmark_prune.py')
+    parser.add_argument('--fast_path', action='store_true',
+                        help='solve degenerate pairs (e.g. one product or one element) in closed form')
 
     args = parser.parse_args()
     logging.warning("arguments: {}".format(vars(args)))
-    records = compute(
+    n_records = compute(
         method=args.method,
         records_pkl=args.records_pkl,
         pairs_pkl=args.pairs_pkl,
         firstk=args.firstk,
         reaction_type=args.reaction_type,
         parallel=args.parallel,
+        threads=args.threads,
+        fast_path=args.fast_path,
+        batch_size=args.batch_size,
+        telemetry_file=args.telemetry_file,
+        time_budget=args.time_budget,
+        prune=args.prune,
+        chunk_size=args.chunk_size,
+        queue_size=args.queue_size,
     )
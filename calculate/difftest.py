@@ -0,0 +1,72 @@
+"""
+run a candidate solver next to a reference solver and report the first pair where they diverge
+"""
+import argparse
+import importlib
+import logging
+import os
+import sys
+
+from whygreedy import pkl_load, gen_random_data
+from whygreedy.calculator import get_cal_function
+from whygreedy.difftest import sample_pairs, find_first_divergence, format_divergence
+
+
+def load_function(path: str):
+    """
+    load a function from `module:function`, e.g. `whygreedy.algo:find_lp_batch`
+    """
+    module_name, function_name = path.split(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Differential testing of a solver.')
+    parser.add_argument('--candidate', dest='candidate', type=str,
+                        help='the candidate solver as module:function, e.g. whygreedy.algo:find_lp_batch')
+    parser.add_argument('--batch', action='store_true',
+                        help='the candidate takes a list of pairs and returns a list of (sol, dh)')
+    parser.add_argument('--method', dest='method', type=str, nargs='?',
+                        help='the reference solver, its kwargs are also passed to the candidate', default='lp',
+                        choices=['lazy', 'diligent', 'lp'])
+    parser.add_argument('--firstk', dest='firstk', type=int, nargs='?', default=None, )
+    parser.add_argument('--reaction_type', dest='reaction_type', type=str, nargs='?', default='oxidation')
+    parser.add_argument('--pairs_pkl', dest='pairs_pkl', type=str, nargs='?',
+                        help='sample pairs from this pkl file', default=None)
+    parser.add_argument('--sample', dest='sample', type=int, nargs='?',
+                        help='number of sampled pairs', default=1000)
+    parser.add_argument('--seed', dest='seed', type=int, nargs='?', default=42)
+    parser.add_argument('--n_random', dest='n_random', type=int, nargs='?',
+                        help='number of `gen_random_data` cases', default=100)
+    parser.add_argument('--random_elements', dest='random_elements', type=str, nargs='+',
+                        default=["Fe", "Si", "Mn"])
+    parser.add_argument('--atol_dh', dest='atol_dh', type=float, nargs='?', default=1e-6)
+    parser.add_argument('--atol_sol', dest='atol_sol', type=float, nargs='?',
+                        help='tolerance of x_i, negative to only compare delta H', default=1e-6)
+    parser.add_argument('--parallel', action='store_true')
+    parser.add_argument('--threads', action='store_true',
+                        help='use a thread pool instead of processes when running in parallel')
+
+    args = parser.parse_args()
+    logging.warning("arguments: {}".format(vars(args)))
+    reference, reference_kwargs = get_cal_function(args.method, args.reaction_type, args.firstk)
+    candidate = load_function(args.candidate)
+    cases = []
+    if args.pairs_pkl is not None:
+        indices, pairs = sample_pairs(pkl_load(args.pairs_pkl), args.sample, args.seed)
+        cases.append(("{} sampled pairs from {}".format(len(pairs), args.pairs_pkl), indices, pairs))
+    if args.n_random > 0:
+        pairs = [gen_random_data(args.random_elements, 3, seed) for seed in range(args.n_random)]
+        cases.append(("{} random pairs".format(len(pairs)), list(range(len(pairs))), pairs))
+
+    diverged = False
+    for description, indices, pairs in cases:
+        divergence = find_first_divergence(
+            pairs, reference, candidate, reference_kwargs=reference_kwargs, candidate_kwargs=reference_kwargs,
+            indices=indices, batch=args.batch, atol_dh=args.atol_dh,
+            atol_sol=None if args.atol_sol < 0 else args.atol_sol,
+            n_jobs=os.cpu_count() if args.parallel else 1, threads=args.threads,
+        )
+        print("{}: {}".format(description, format_divergence(divergence)))
+        diverged = diverged or divergence is not None
+    sys.exit(1 if diverged else 0)
@@ -1,19 +1,41 @@
-from whygreedy import load_mp_oxidation_pairs, file_exists, pkl_load, pkl_dump
+import argparse
+import shutil
+
+from whygreedy.cache import PairCache, get_default_criteria
+from whygreedy.mp import mpdata
+from whygreedy.utils import pairs_meta_path
 
 # a `pair` is a tuple of (reactant, product list)
 # each pair correspond to a reaction, based on which the reaction enthalpy minimization is performed
-
-mp_oxidation_pairs_pkl = "mp_oxidation_pairs.pkl"  # the pairs for oxidation reactions from stable, oxygen-free compounds
+# pairs are cached in `--cache_dir` by the hash of `mp.json.gz`, reaction type and criteria,
+# the right artifact is then copied to `mp_<reaction_type>_pairs.pkl`, e.g. `mp_oxidation_pairs.pkl`,
+# with its sidecar `mp_<reaction_type>_pairs.pkl.meta.json`
 
 if __name__ == '__main__':
-    pairs_pkl = mp_oxidation_pairs_pkl
-    load_pairs_function = load_mp_oxidation_pairs
-    if file_exists(pairs_pkl):
-        print("Found file: {}".format(pairs_pkl))
-        pairs = pkl_load(pairs_pkl)
+    parser = argparse.ArgumentParser(description='Extract reactions from mp.json.gz.')
+    parser.add_argument('--reaction_types', dest='reaction_types', type=str, nargs='+',
+                        help='oxidation, decomposition, nitridation, hydration, carbonation, '
+                             'the ones not cached are extracted in one pass', default=['oxidation'])
+    parser.add_argument('--criteria', dest='criteria', type=float, nargs='?',
+                        help='e_above_hull (meV) criteria for compounds, negative to use all compounds, '
+                             'default 50 for oxidation and all compounds for decomposition', default=None)
+    parser.add_argument('--mp_json', dest='mp_json', type=str, nargs='?', default=mpdata)
+    parser.add_argument('--cache_dir', dest='cache_dir', type=str, nargs='?', default='pairs_cache')
+    args = parser.parse_args()
+
+    if args.criteria is None:
+        criteria = "default"
+    elif args.criteria < 0:
+        criteria = None
     else:
-        print("File not found: {}".format(pairs_pkl))
-        print("loading with: {}".format(load_pairs_function.__name__))
-        pairs = load_pairs_function()
-        pkl_dump(pairs, pairs_pkl)
-    print("# of pairs: {}".format(len(pairs)))
+        criteria = args.criteria
+    cache = PairCache(args.cache_dir, mp_json=args.mp_json)
+    environment_pairs = cache.get_environment_pairs(args.reaction_types, criteria=criteria)
+    for reaction_type, pairs in environment_pairs.items():
+        reaction_criteria = get_default_criteria(reaction_type) if criteria == "default" else criteria
+        pairs_pkl = "mp_{}_pairs.pkl".format(reaction_type)
+        fn = cache.pairs_path(reaction_type, reaction_criteria)
+        # the sidecar gives the number of pairs to `calculate.py` without reading them
+        shutil.copyfile(pairs_meta_path(fn), pairs_meta_path(pairs_pkl))
+        shutil.copyfile(fn, pairs_pkl)
+        print("# of {} pairs: {}, saved as: {}".format(reaction_type, len(pairs), pairs_pkl))
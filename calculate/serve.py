@@ -0,0 +1,16 @@
+import argparse
+
+from whygreedy.query import StabilityQuery, serve
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve reaction enthalpy queries over http.')
+    parser.add_argument('--criteria', dest='criteria', type=float, nargs='?',
+                        help='e_above_hull (meV) criteria for compounds used as products', default=50)
+    parser.add_argument('--maxsize', dest='maxsize', type=int, nargs='?',
+                        help='max number of queries kept in the LRU cache', default=4096)
+    parser.add_argument('--host', dest='host', type=str, nargs='?', default='127.0.0.1')
+    parser.add_argument('--port', dest='port', type=int, nargs='?', default=8000)
+
+    args = parser.parse_args()
+    query = StabilityQuery.from_mp(criteria=args.criteria, maxsize=args.maxsize)
+    serve(query, host=args.host, port=args.port)
@@ -0,0 +1,31 @@
+import argparse
+
+from whygreedy import pkl_load, pkl_dump_pairs
+from whygreedy.workload import gen_synthetic_pairs, WorkloadProfile, MP_OXIDATION_NPAIRS, MP_DECOMPOSITION_NPAIRS
+
+# synthetic pairs for capacity planning, the output can be used as `--pairs_pkl` in `calculate.py`
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic pairs at the scale of materials project.')
+    parser.add_argument('--pairs_pkl', dest='pairs_pkl', type=str, nargs='?',
+                        help='pkl filename for resulting pairs', default="synthetic_pairs.pkl")
+    parser.add_argument('--reaction_type', dest='reaction_type', type=str, nargs='?',
+                        help='oxidation, decomposition', default='oxidation', choices=['oxidation', 'decomposition'])
+    parser.add_argument('--scale', dest='scale', type=float, nargs='?',
+                        help='number of pairs relative to materials project', default=1.0)
+    parser.add_argument('--seed', dest='seed', type=int, nargs='?', default=42)
+    parser.add_argument('--chunk_size', dest='chunk_size', type=int, nargs='?', default=10000)
+    parser.add_argument('--profile_pairs_pkl', dest='profile_pairs_pkl', type=str, nargs='?',
+                        help='existing pkl file of real pairs to fit the distributions', default=None)
+
+    args = parser.parse_args()
+    for_oxide = args.reaction_type == "oxidation"
+    if args.profile_pairs_pkl is None:
+        profile = WorkloadProfile.default()
+    else:
+        profile = WorkloadProfile.from_pairs(pkl_load(args.profile_pairs_pkl), for_oxide=for_oxide)
+    n_pairs = round(args.scale * (MP_OXIDATION_NPAIRS if for_oxide else MP_DECOMPOSITION_NPAIRS))
+    pkl_dump_pairs(
+        gen_synthetic_pairs(n_pairs, seed=args.seed, for_oxide=for_oxide, profile=profile, chunk_size=args.chunk_size),
+        args.pairs_pkl
+    )
@@ -1,22 +1,35 @@
+import json
 import random
+import time
 
 import numpy as np
 import pytest
 
-from whygreedy import pkl_load, json_load, find_lp, find_greedy_first_choices
+from calculate.calculate import compute
+from whygreedy import pkl_load, json_load, json_dump, find_lp, find_greedy, find_greedy_first_choices, gen_random_data, \
+    ChemsysIndex, StabilityQuery, pkl_dump, pkl_dump_chunks, pkl_dump_pairs, load_pairs_meta, check_solution
+from whygreedy.algo import find_lp_batch
+from whygreedy.analytics import records_to_arrays, compare_methods
+from whygreedy.cache import PairCache
+from whygreedy.calculator import Calculator, get_cal_function
+from whygreedy.difftest import sample_pairs, find_first_divergence, format_divergence
+from whygreedy.mp import find_oxide_pairs_from_compounds, find_environment_pairs_from_compounds
+from whygreedy.pipeline import prefetch, consume_in_background, chunked
+from whygreedy.utils import CODECS, MAGIC, detect_codec, zstandard, lz4
+from whygreedy.workload import gen_synthetic_pairs, WorkloadProfile, DEFAULT_ELEMENTS
 
 
 class TestChemmat:
 
-    @pytest.fixture
+    @pytest.fixture(scope="session")
     def oxidation_pairs(self):
         return pkl_load("data/mp_oxidation_pairs.pkl")
 
-    @pytest.fixture
+    @pytest.fixture(scope="session")
     def oxidation_records(self):
         return pkl_load("data/mp_oxidation_records.pkl")
 
-    @pytest.fixture
+    @pytest.fixture(scope="session")
     def mp_data(self):
         return json_load("data/mp.json.gz")
 
@@ -38,3 +51,371 @@ class TestChemmat:
             sol, dh = find_greedy_first_choices(*oxidation_pairs[i], for_oxide=True, diligent_greedy=False, firstk=3)
             assert np.allclose(sol, oxidation_records[i]['sol_lazy_f3'])
             assert np.allclose(dh, oxidation_records[i]['dh_lazy_f3'])
+
+    def test_differential(self, oxidation_pairs):
+        indices, pairs = sample_pairs(oxidation_pairs, 200)
+        for method in ["lp", "diligent"]:
+            reference, kwargs = get_cal_function(method, "oxidation", firstk=3)
+            divergence = find_first_divergence(pairs, reference, solve_with_fast_path, reference_kwargs=kwargs,
+                                               candidate_kwargs=dict(kwargs, method=method), indices=indices,
+                                               n_jobs=4, threads=True)
+            assert divergence is None, format_divergence(divergence)
+
+
+def solve_with_fast_path(reactant, products, method, **kwargs):
+    calculator = Calculator([], "fast_path", *get_cal_function(method, "oxidation", kwargs.get("firstk")),
+                            fast_path=True)
+    record = calculator.cal_one((reactant, products))
+    return record["sol"], record["dh"]
+
+
+def slow_lp(reactant, products):
+    time.sleep(1)
+    return find_lp(reactant, products)
+
+
+class TestRandom:
+
+    @pytest.fixture(scope="session")
+    def random_pairs(self):
+        return [gen_random_data(["Fe", "Si", "Mn"], 3, seed) for seed in range(10)]
+
+    def test_query(self, random_pairs):
+        reactant, products = random_pairs[0]
+        query = StabilityQuery(ChemsysIndex(products))
+        formula = {k: v * 3 for k, v in reactant.normalized_formula.items()}
+        record = query.query(formula, reactant.formation_energy_per_atom, method="lp", reaction_type="oxidation")
+        sol, dh = find_lp(reactant, query.index.find_products(reactant.elements, for_oxide=True))
+        assert np.allclose(record["sol"], sol)
+        assert np.allclose(record["dh"], dh)
+        assert len(record["products"]) == len(products)
+        query.query(formula, reactant.formation_energy_per_atom, method="lp", reaction_type="oxidation")
+        assert query.cache_info().hits == 1
+        # no candidate products
+        for method in ["lp", "lazy", "diligent"]:
+            record = query.query("Mn2", -0.1, method=method, reaction_type="decomposition")
+            assert record["sol"] == [] and record["products"] == []
+            assert np.isclose(record["dh"], 0.1)
+
+    def test_synthetic_pairs(self, tmp_path):
+        chunks = list(gen_synthetic_pairs(25, seed=42, for_oxide=True, chunk_size=10))
+        assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+        fn = tmp_path / "synthetic_pairs.pkl"
+        assert pkl_dump_chunks(gen_synthetic_pairs(25, seed=42, for_oxide=True, chunk_size=10), fn) == 25
+        pairs = pkl_load(fn)
+        assert len(pairs) == 25
+        for (reactant, products), (reactant_, products_) in zip(pairs, [p for chunk in chunks for p in chunk]):
+            assert reactant.normalized_formula == reactant_.normalized_formula
+            assert len(products) == len(products_) > 0
+            assert all(p.is_oxide for p in products)
+
+    def test_threaded(self, random_pairs):
+        reactant, products = random_pairs[0]
+        # all pairs share the same products
+        pairs = [(r, products) for r, _ in random_pairs]
+        calculator = Calculator(pairs, name="threaded", cal_function=find_greedy_first_choices,
+                                cal_function_kwargs={"diligent_greedy": True, "for_oxide": True})
+        records_threaded = calculator.cal_threaded(n_jobs=4)
+        records_serial = calculator.cal_serial()
+        for record_threaded, record_serial in zip(records_threaded, records_serial):
+            assert np.allclose(record_threaded["sol"], record_serial["sol"])
+            assert np.allclose(record_threaded["dh"], record_serial["dh"])
+        assert all(len(p.properties) == 0 for p in products)
+
+    def test_fast_path(self):
+        # few elements and products so many pairs are degenerate
+        profile = WorkloadProfile(DEFAULT_ELEMENTS[:4], [1.0, ] * 4, {1: 0.5, 2: 0.5}, products_per_chemsys=1.0)
+        pairs = next(gen_synthetic_pairs(100, seed=42, for_oxide=True, profile=profile, chunk_size=100))
+        pairs.append((pairs[0][0], []))
+        for method in ["lp", "diligent", "lazy"]:
+            cal_function, cal_function_kwargs = get_cal_function(method, "oxidation")
+            records_fast = Calculator(pairs, "fast", cal_function, cal_function_kwargs, fast_path=True).cal_serial()
+            records = Calculator(pairs, "general", cal_function, cal_function_kwargs).cal_serial()
+            assert Calculator.count_paths(records_fast)["single_element"] > 0
+            assert sum(Calculator.count_paths(records_fast).values()) == len(pairs)
+            for record_fast, record in zip(records_fast, records):
+                if record["sol"] is None:
+                    # greedy with no product
+                    assert record_fast["sol"] is None and record_fast["dh"] == record["dh"]
+                    continue
+                assert np.allclose(record_fast["sol"], record["sol"])
+                assert np.allclose(record_fast["dh"], record["dh"])
+
+    def test_lp_batch(self, random_pairs):
+        # stay below the size limit of the restricted gurobi license
+        pairs = random_pairs[:5] + [(random_pairs[0][0], [])]
+        for (sol_batch, dh_batch), pair in zip(find_lp_batch(pairs), pairs):
+            sol, dh = find_lp(*pair)
+            assert np.allclose(sol_batch, sol)
+            assert np.allclose(dh_batch, dh)
+        records = Calculator(pairs, "batched", find_lp, {}).cal_batched(batch_size=2, n_jobs=2)
+        assert np.allclose([record["dh"] for record in records], [find_lp(*pair)[1] for pair in pairs])
+
+    def test_telemetry(self, random_pairs, tmp_path):
+        fn = tmp_path / "metrics.jsonl"
+        calculator = Calculator(random_pairs, "telemetry", find_lp, {}, telemetry_file=fn, telemetry_interval=0)
+        calculator.cal_threaded(n_jobs=2)
+        with open(fn) as f:
+            snapshots = [json.loads(line) for line in f]
+        assert snapshots[-1]["pairs_done"] == snapshots[-1]["pairs_total"] == len(random_pairs)
+        assert snapshots[-1]["method"] == "find_lp"
+        assert snapshots[-1]["eta_seconds"] == 0
+        assert 0 < sum(snapshots[-1]["worker_utilization"].values()) <= 2 + 1e-6
+
+    def test_compute_telemetry(self, random_pairs, tmp_path):
+        # pairs are streamed from the file, the total and ETA are known from the sidecar of `pkl_dump_pairs`
+        pairs_pkl = tmp_path / "pairs.pkl"
+        pkl_dump_pairs([random_pairs[:4], random_pairs[4:]], pairs_pkl)
+        meta = load_pairs_meta(pairs_pkl)
+        assert meta["n_pairs"] == len(random_pairs)
+        assert sum(n * count for n, count in meta["n_products"].items()) == sum(len(ps) for _, ps in random_pairs)
+        snapshots = []
+        for with_meta in [True, False]:
+            if not with_meta:
+                # the pairs file changed since, the sidecar is not used
+                pkl_dump_chunks([random_pairs], pairs_pkl)
+                assert load_pairs_meta(pairs_pkl) is None
+            records_pkl = tmp_path / "records_{}.pkl".format(with_meta)
+            fn = tmp_path / "metrics_{}.jsonl".format(with_meta)
+            n_records = compute("lp", str(records_pkl), str(pairs_pkl), None, "oxidation", parallel=False,
+                                telemetry_file=str(fn), chunk_size=3, queue_size=1)
+            assert n_records == len(random_pairs)
+            with open(fn) as f:
+                snapshots.append([json.loads(line) for line in f])
+        assert all(s["pairs_total"] == len(random_pairs) for s in snapshots[0])
+        assert all(s["eta_seconds"] is not None for s in snapshots[0] if s["pairs_done"] > 0)
+        assert snapshots[0][-1]["eta_seconds"] == 0
+        assert all(s["pairs_total"] is None and s["eta_seconds"] is None for s in snapshots[1])
+        assert snapshots[1][-1]["pairs_done"] == len(random_pairs)
+
+    def test_telemetry_heartbeat(self, random_pairs, tmp_path):
+        # nothing finishes for a while, the heartbeat still shows the pairs in flight
+        for parallel in [False, True]:
+            fn = tmp_path / "metrics_{}.jsonl".format(parallel)
+            calculator = Calculator(random_pairs[:2], "heartbeat", slow_lp, {}, telemetry_file=fn,
+                                    telemetry_interval=0.1)
+            calculator.cal_parallel(n_jobs=2) if parallel else calculator.cal_threaded(n_jobs=2)
+            with open(fn) as f:
+                snapshots = [json.loads(line) for line in f]
+            stalled = [s for s in snapshots if s["pairs_done"] == 0 and s["pairs_in_flight"] == 2]
+            assert len(stalled) > 0
+            assert max(max(s["worker_running_seconds"].values()) for s in stalled) > 0.2
+            assert snapshots[-1]["pairs_in_flight"] == 0
+            assert all(v == 0 for v in snapshots[-1]["worker_in_flight"].values())
+
+    def test_environment_pairs(self):
+        compounds = []
+        for reactant, products in next(gen_synthetic_pairs(50, seed=42, for_oxide=True, chunk_size=50)):
+            compounds += [reactant] + products
+        compounds = list({id(c): c for c in compounds}.values())
+        environment_pairs = find_environment_pairs_from_compounds(compounds, ["oxidation", "nitridation"])
+        assert [(r, ps) for r, ps in find_oxide_pairs_from_compounds(compounds)] == environment_pairs["oxidation"]
+        assert len(environment_pairs["nitridation"]) > 0
+        cal_function, cal_function_kwargs = get_cal_function("diligent", "nitridation")
+        for reactant, products in environment_pairs["nitridation"][:10]:
+            assert all("N" in p.elements and "N" not in reactant.elements for p in products)
+            sol, dh = cal_function(reactant, products, **cal_function_kwargs)
+            sol_lp, dh_lp = find_lp(reactant, products)
+            assert dh_lp <= dh + 1e-7
+
+    def test_pair_cache(self, tmp_path):
+        mp_data = []
+        for reactant, products in next(gen_synthetic_pairs(20, seed=42, for_oxide=True, chunk_size=20)):
+            for c in [reactant] + products:
+                mp_data.append({
+                    "task_id": c.mpid, "unit_cell_formula": c.normalized_formula,
+                    "nsites": sum(c.normalized_formula.values()),
+                    "formation_energy_per_atom": c.formation_energy_per_atom, "e_above_hull": len(mp_data) % 3 * 0.03,
+                })
+        mp_data = list({d["task_id"]: d for d in mp_data}.values())
+        mp_json = tmp_path / "mp.json.gz"
+        json_dump(mp_data, mp_json)
+        cache = PairCache(tmp_path / "cache", mp_json=mp_json)
+        oxidation_pairs = cache.get_pairs("oxidation")
+        decomposition_pairs = cache.get_pairs("decomposition")
+        assert len(decomposition_pairs) == len(mp_data)
+        assert load_pairs_meta(cache.pairs_path("oxidation", 50))["n_pairs"] == len(oxidation_pairs)
+        assert cache.pairs_path("oxidation", 50) != cache.pairs_path("oxidation", 100)
+        assert cache.pairs_path("oxidation", 50) == cache.pairs_path("oxidation", 50.0)
+
+        # a new cache reuses the artifacts
+        cache = PairCache(tmp_path / "cache", mp_json=mp_json)
+        assert [r.mpid for r, _ in cache.get_pairs("oxidation")] == [r.mpid for r, _ in oxidation_pairs]
+        assert cache._mp_compounds is None
+
+        # a changed source is a different key
+        json_dump(mp_data[:-1], mp_json)
+        assert PairCache(tmp_path / "cache", mp_json=mp_json).pairs_path("oxidation", 50) != \
+               cache.pairs_path("oxidation", 50)
+
+    def test_analytics(self, random_pairs):
+        records = []
+        for reactant, products in random_pairs:
+            sol_lp, dh_lp = find_lp(reactant, products)
+            sol_lazy, dh_lazy = find_greedy_first_choices(reactant, products, diligent_greedy=False, for_oxide=True,
+                                                          firstk=1)
+            records.append(dict(sol_lp=sol_lp, dh_lp=dh_lp, sol_lazy=sol_lazy, dh_lazy=dh_lazy))
+        arrays = records_to_arrays(iter(records), iter(random_pairs))
+        gaps = np.array([r["dh_lp"] - r["dh_lazy"] for r in records])
+        summary = compare_methods(arrays, "lp", "lazy")
+        assert summary["count"][0] == len(records)
+        assert summary["n_a_better"][0] == np.sum(gaps < -1e-5)
+        assert summary["n_b_better"][0] == 0
+        assert np.isclose(summary["min_gap"][0], gaps.min())
+        summary = compare_methods(arrays, "lp", "lazy", by="n_products")
+        assert sum(summary["count"]) == len(records)
+        assert sum(summary["n_invalid"]) == 0
+        # greedy finds no solution for a pair without products
+        reactant = random_pairs[0][0]
+        sol_lp, dh_lp = find_lp(reactant, [])
+        sol_lazy, dh_lazy = find_greedy_first_choices(reactant, [], diligent_greedy=False, for_oxide=True, firstk=1)
+        assert sol_lazy is None and dh_lazy == np.inf
+        records.append(dict(sol_lp=sol_lp, dh_lp=dh_lp, sol_lazy=sol_lazy, dh_lazy=dh_lazy))
+        arrays = records_to_arrays(iter(records), iter(random_pairs + [(reactant, [])]))
+        assert arrays["n_products"][-1] == 0 and arrays["nnz_lazy"][-1] == 0
+        summary = compare_methods(arrays, "lp", "lazy")
+        assert summary["count"][0] == len(records)
+        assert summary["n_invalid"][0] == 1
+        assert np.isclose(summary["min_gap"][0], gaps.min())
+        assert np.isclose(summary["mean_gap"][0], gaps.mean())
+        summary = compare_methods(arrays, "lp", "lazy", by="n_products")
+        assert summary["group"][0] == 0 and summary["n_invalid"][0] == 1 and np.isnan(summary["mean_gap"][0])
+        assert records_to_arrays(iter(records))["n_products"][-1] == 0
+
+    def test_differential(self, random_pairs):
+        reference, kwargs = get_cal_function("lp", "oxidation")
+        divergence = find_first_divergence(random_pairs, reference, find_lp_batch, batch=True, n_jobs=2,
+                                           threads=True, chunk_size=3)
+        assert divergence is None, format_divergence(divergence)
+        divergence = find_first_divergence(random_pairs, reference, solve_with_fast_path,
+                                           candidate_kwargs=dict(method="lp"), n_jobs=2, threads=True, chunk_size=3)
+        assert divergence is None, format_divergence(divergence)
+
+        def shifted(reactant, products):
+            sol, dh = find_lp(reactant, products)
+            return sol, dh + 1e-3 if reactant is random_pairs[7][0] or reactant is random_pairs[4][0] else dh
+
+        divergence = find_first_divergence(random_pairs, reference, shifted, indices=list(range(10, 20)),
+                                           n_jobs=2, threads=True, chunk_size=3)
+        assert divergence["index"] == 14 and divergence["reason"] == "dh"
+        assert find_first_divergence(random_pairs, reference, shifted, atol_dh=1e-2) is None
+        # pairs without products: greedy finds no solution, lp does
+        reactant = random_pairs[3][0]
+        pairs = random_pairs[:3] + [(reactant, [])] + random_pairs[3:]
+        diligent, diligent_kwargs = get_cal_function("diligent", "oxidation")
+        assert find_first_divergence(pairs, diligent, diligent, reference_kwargs=diligent_kwargs,
+                                     candidate_kwargs=diligent_kwargs, n_jobs=2, threads=True, chunk_size=3) is None
+        divergence = find_first_divergence(pairs, reference, diligent, candidate_kwargs=diligent_kwargs)
+        assert divergence["index"] == 3 and divergence["reason"] == "missing"
+
+        def infeasible(reactant, products):
+            raise RuntimeError("infeasible")
+
+        divergence = find_first_divergence(pairs, infeasible, reference, n_jobs=2, threads=True, chunk_size=3)
+        assert divergence["index"] == 0 and divergence["reason"] == "reference_error"
+        # same sample as the stored-records tests, the global random state is left alone
+        random.seed(0)
+        state = random.getstate()
+        indices, _ = sample_pairs(random_pairs, 5)
+        assert random.getstate() == state
+        random.seed(42)
+        assert indices == random.sample(range(len(random_pairs)), 5)
+
+    def test_time_budget(self, random_pairs):
+        for reactant, products in random_pairs:
+            sol, dh = find_greedy_first_choices(reactant, products, diligent_greedy=True, for_oxide=True)
+            result = find_greedy_first_choices(reactant, products, diligent_greedy=True, for_oxide=True,
+                                               time_budget=60, return_search_info=True)
+            assert result == (sol, dh, len(products), True)
+            # the most favored first choice is always tried
+            sol, dh, n_explored, finished = find_greedy_first_choices(
+                reactant, products, diligent_greedy=True, for_oxide=True, time_budget=0, return_search_info=True)
+            assert (n_explored, finished) == (1, False)
+            assert (sol, dh) == find_greedy(reactant, products, first_choice=0, diligent_greedy=True, for_oxide=True)
+        with pytest.raises(ValueError):
+            get_cal_function("lp", "oxidation", time_budget=1)
+        calculator = Calculator(random_pairs, "anytime", *get_cal_function("lazy", "oxidation", time_budget=0))
+        records = calculator.cal_serial()
+        assert all(r["n_explored"] == 1 for r in records)
+        assert Calculator.count_unfinished(records) == len(records)
+
+    def test_codecs(self, random_pairs, tmp_path):
+        # zstd and lz4 are optional
+        codecs = [codec for codec in CODECS if
+                  not (codec == "zstd" and zstandard is None) and not (codec == "lz4" and lz4 is None)]
+        records = [dict(sol=np.arange(5.0), dh=-1.0), dict(sol=np.ones(3), dh=-2.0)]
+        for codec in codecs:
+            fn = tmp_path / "pairs.pkl"
+            pkl_dump(random_pairs, fn, codec=codec)
+            assert detect_codec(fn) == codec
+            assert [p[0].normalized_formula for p in pkl_load(fn)] == [p[0].normalized_formula for p in random_pairs]
+            pkl_dump_chunks([records[:1], records[1:]], fn, codec=codec, out_of_band=True, threads=2)
+            loaded = pkl_load(fn)
+            assert len(loaded) == 2 and np.array_equal(loaded[1]["sol"], records[1]["sol"])
+            fn = tmp_path / "data.json.gz"
+            json_dump({"a": [1, 2]}, fn, codec=codec)
+            assert json_load(fn) == {"a": [1, 2]}
+        # a broken gzip file is not read again as plain json
+        with open(tmp_path / "broken.json.gz", "wb") as f:
+            f.write(MAGIC["gzip"] + b"not gzip")
+        with pytest.raises(Exception) as e:
+            json_load(tmp_path / "broken.json.gz")
+        assert not isinstance(e.value, json.JSONDecodeError)
+
+    def test_prune(self, random_pairs):
+        calculator = Calculator(random_pairs, "prune", *get_cal_function("lp", "oxidation"), prune=True)
+        for records in [calculator.cal_serial(), calculator.cal_batched(batch_size=3)]:
+            for (reactant, products), record in zip(random_pairs, records):
+                sol, dh = find_lp(reactant, products)
+                assert len(record["sol"]) == len(products)
+                assert check_solution(record["sol"], products, reactant)
+                assert np.isclose(record["dh"], dh)
+            shrinkage = Calculator.count_pruned(records)
+            assert shrinkage["n_products_after"] < shrinkage["n_products_before"]
+        assert calculator.pruner.report()["cache_hits"] > 0
+        # pairs are pruned in the parent of a process pool, so its cache and counts are used,
+        # the repeated pairs hit the cache
+        pairs = random_pairs + random_pairs
+        calculator = Calculator(pairs, "prune", *get_cal_function("lp", "oxidation"), prune=True)
+        assert calculator.pruner.report()["fraction_removed"] == 0
+        assert Calculator.count_pruned([])["fraction_removed"] == 0
+        records = calculator.cal_parallel(n_jobs=2)
+        assert [r["dh"] for r in records] == pytest.approx([find_lp(*p)[1] for p in pairs])
+        report = calculator.pruner.report()
+        assert report["n_pairs"] == len(pairs)
+        assert report["cache_hits"] > 0
+        assert report["n_products_after"] == Calculator.count_pruned(records)["n_products_after"]
+        with pytest.raises(ValueError):
+            Calculator(random_pairs, "prune", *get_cal_function("diligent", "oxidation"), prune=True)
+        # decomposition pairs leave the reactant out, a product it dominates is checked against the pair again
+        compounds = []
+        for reactant, products in next(gen_synthetic_pairs(100, seed=42, for_oxide=False, chunk_size=100)):
+            compounds += [reactant] + products
+        compounds = list({c.mpid: c for c in compounds}.values())
+        pairs = find_environment_pairs_from_compounds(compounds, ["decomposition"])["decomposition"][:300]
+        calculator = Calculator(pairs, "prune", *get_cal_function("lp", "decomposition"), prune=True)
+        records = calculator.cal_serial()
+        assert [r["dh"] for r in records] == pytest.approx([find_lp(*p)[1] for p in pairs])
+        report = calculator.pruner.report()
+        assert report["n_rechecks"] > 0
+        assert report["cache_hits"] > report["cache_misses"]
+        assert report["fraction_removed"] > 0.5
+
+    def test_stream(self, random_pairs, tmp_path):
+        calculator = Calculator([], "stream", *get_cal_function("diligent", "oxidation", firstk=2))
+        expected = [calculator.cal_one(p)["dh"] for p in random_pairs]
+        records = calculator.cal_stream(prefetch(iter(random_pairs), maxsize=2), n_jobs=3, threads=True,
+                                        max_pending_per_job=1)
+        fn = tmp_path / "records.pkl"
+        n = consume_in_background(lambda chunks: pkl_dump_chunks(chunks, fn), chunked(records, 3), maxsize=1)
+        assert n == len(random_pairs)
+        assert [r["dh"] for r in pkl_load(fn)] == expected
+
+        def broken():
+            yield random_pairs[0]
+            raise RuntimeError("broken pairs file")
+
+        with pytest.raises(RuntimeError):
+            list(calculator.cal_stream(prefetch(broken(), maxsize=1)))
+        with pytest.raises(ZeroDivisionError):
+            consume_in_background(lambda items: [1 / i for i in items], iter([1, 0, 2, 3]), maxsize=1)
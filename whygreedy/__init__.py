@@ -1,6 +1,9 @@
-from .utils import json_dump, json_load, pkl_dump, pkl_load, file_exists, set_small_to_zeros
+from .utils import json_dump, json_load, pkl_dump, pkl_load, pkl_dump_chunks, pkl_load_chunks, pkl_iter, \
+    pkl_dump_pairs, load_pairs_meta, pairs_meta_path, file_exists, set_small_to_zeros, open_compressed, detect_codec
 from .schema import Compound, gen_random_data, normalize_stoi, is_close_to_zero
-from .mp import load_mp_oxidation_pairs, load_mp_decomposition_pairs
+from .mp import load_mp_oxidation_pairs, load_mp_decomposition_pairs, load_mp_environment_pairs
 from .algo import find_lp, find_greedy, find_greedy_old, check_solution, calculate_ranking_parameter,\
-    find_greedy_old_first_choices, find_greedy_first_choices
-from .notebook import calculate_diligent_vs_lazy_oxidation
\ No newline at end of file
+    find_greedy_old_first_choices, find_greedy_first_choices, search_first_choices
+from .notebook import calculate_diligent_vs_lazy_oxidation
+from .index import ChemsysIndex
+from .query import StabilityQuery, parse_formula
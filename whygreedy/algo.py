@@ -1,12 +1,13 @@
+import time
 from copy import deepcopy
-from typing import Tuple
+from typing import Tuple, Callable
 
 import gurobipy as gp
 import numpy as np
 from gurobipy import GRB
 
 from whygreedy.Twyman2022ChemMat import find_comp
-from whygreedy.schema import Compound, is_close_to_zero, compound_subtract
+from whygreedy.schema import Compound, is_close_to_zero, compound_subtract, get_reactive_species, REACTIVE_SPECIES
 
 """
 implement the greedy algorithm proposed by the authors of 10.1021/acs.chemmater.1c02644
@@ -42,21 +43,23 @@ def check_solution(solution: list[float], products: list[Compound], reactant: Co
     return all(checks.values())
 
 
-def calculate_ranking_parameter(product: Compound, reactant: Compound, for_oxide: bool) -> float:
+def calculate_ranking_parameter(
+        product: Compound, reactant: Compound, for_oxide: bool, reactive_species: tuple[str, ...] = None
+) -> float:
     """
     this is the ranking parameter as defined in the paper, a smaller number indicated the oxide is more favored,
-    the one with the smallest ranking parameter will be used to "consume" the original compound
+    the one with the smallest ranking parameter will be used to "consume" the original compound,
+    elements in `reactive_species` (default to oxygen if `for_oxide`) are supplied by the environment and excluded
     """
     # if the product has an element with > 0 composition,
     # and this element is not present or is of 0 composition in the reactant,
     # then the ranking parameter is inf because it is impossible to consume the reactant with this product
     # (and x_i for this product is 0)
-    if for_oxide:
-        assert "O" not in reactant.normalized_formula, "you are calculating ranking param for an oxidation reaction, " \
-                                                       "but your reactant has oxygen"
-        check_elements = product.elements_exclude_oxygen
-    else:
-        check_elements = product.elements
+    reactive_species = get_reactive_species(for_oxide, reactive_species)
+    for e in reactive_species:
+        assert e not in reactant.normalized_formula, "you are calculating ranking param for a reaction with " \
+                                                     "{}, but your reactant has {}".format(reactive_species, e)
+    check_elements = product.elements_exclude(reactive_species)
 
     for e in check_elements:
         product_composition = product.normalized_formula[e]
@@ -73,6 +76,7 @@ def calculate_ranking_parameter(product: Compound, reactant: Compound, for_oxide
 
 def find_greedy(
         reactant: Compound, products: list[Compound], first_choice: int, diligent_greedy: bool, for_oxide: bool,
+        reactive_species: tuple[str, ...] = None,
 ) -> Tuple[list[float], float]:
     if len(products) == 0:
         return [], - reactant.formation_energy_per_atom
@@ -82,18 +86,16 @@ def find_greedy(
     # sum of formation enthalpies of products
     final_enthalpy = 0.0
 
-    # assign an index for oxides
-    for iprod, prod in enumerate(products):
-        prod.properties["index"] = iprod
-
     # we will be updating the original compound, better make a deep copy
     updated_reactant = deepcopy(reactant)
-    sorted_products = products  # no need for deep copy
+    # keep the index of each product along with it, the products are not modified as they may be shared
+    sorted_products = list(enumerate(products))
 
     # init the loop and perform the first greedy ranking
     counter = 0
     sorted_products = sorted(sorted_products,
-                             key=lambda x: calculate_ranking_parameter(x, updated_reactant, for_oxide=for_oxide))
+                             key=lambda x: calculate_ranking_parameter(x[1], updated_reactant, for_oxide=for_oxide,
+                                                                       reactive_species=reactive_species))
 
     while len(solution) < len(products):
         if diligent_greedy:
@@ -103,27 +105,29 @@ def find_greedy(
             # so strictly speaking it is not a greedy algorithm
             # this becomes even more problematic considering they exhausted all possible `first_choice`
             sorted_products = sorted(sorted_products,
-                                     key=lambda x: calculate_ranking_parameter(x, updated_reactant,
-                                                                               for_oxide=for_oxide))
+                                     key=lambda x: calculate_ranking_parameter(x[1], updated_reactant,
+                                                                               for_oxide=for_oxide,
+                                                                               reactive_species=reactive_species))
         # we can force the first choice to be something else, but always choose the best starting the 2nd iteration
         if counter == 0:
-            favored_product = sorted_products[first_choice]
+            favored_index, favored_product = sorted_products[first_choice]
             index_to_pop = first_choice
         else:
-            favored_product = sorted_products[0]
+            favored_index, favored_product = sorted_products[0]
             index_to_pop = 0
         # once the favored product is identified, we can calculate the ratio,
         # and subtract it from the reactant
-        ratio, updated_reactant = compound_subtract(favored_product, updated_reactant, for_oxide=for_oxide)
+        ratio, updated_reactant = compound_subtract(favored_product, updated_reactant, for_oxide=for_oxide,
+                                                    reactive_species=reactive_species)
         # remove the favored oxide from ranking
         sorted_products.pop(index_to_pop)
         # update solution
-        solution.append((favored_product.properties["index"], ratio))
+        solution.append((favored_index, ratio))
         final_enthalpy += ratio * favored_product.formation_energy_per_atom
         # if the original has been consumed, fill in solution and break the loop
         if all(is_close_to_zero(v, 1e-7) for v in updated_reactant.normalized_formula.values()):
-            for remaining_product in sorted_products:
-                solution.append((remaining_product.properties["index"], 0.0))
+            for remaining_index, _ in sorted_products:
+                solution.append((remaining_index, 0.0))
             break
 
         # update counter before next iteration
@@ -135,11 +139,18 @@ def find_greedy(
 
 def find_greedy_old(
         reactant: Compound, products: list[Compound], first_choice: int, for_oxide: bool,
+        reactive_species: tuple[str, ...] = None,
 ) -> Tuple[list[float], float]:
     """
     This is just a wrapper for the implementation from 10.1021/acs.chemmater.1c02644
     It is identical to `find_greedy` with `diligent_greedy` set to False
+    `find_comp` only modifies the copies made here, so the reactant and products are left untouched
+    `find_comp` only knows oxidation and decomposition, other `reactive_species` are not supported
     """
+    reactive_species = get_reactive_species(for_oxide, reactive_species)
+    if reactive_species not in (REACTIVE_SPECIES["oxidation"], REACTIVE_SPECIES["decomposition"]):
+        raise ValueError("`find_greedy_old` cannot be used with reactive species: {}".format(reactive_species))
+    for_oxide = reactive_species == REACTIVE_SPECIES["oxidation"]
     if len(products) == 0:
         return [], - reactant.formation_energy_per_atom
 
@@ -154,7 +165,7 @@ def find_greedy_old(
             "elements": product.elements,
         }
         stable_products.append(stable_product)
-    compound_unit_cell = reactant.normalized_formula
+    compound_unit_cell = {k: v for k, v in reactant.normalized_formula.items()}
 
     if for_oxide:
         solution_oxides, final_enthalpy, delta_enthalpy, _, _, _ = find_comp(stable_products, compound_unit_cell,
@@ -221,38 +232,129 @@ def find_lp(reactant: Compound, products: list[Compound], ) -> Tuple[list[float]
             return [v.x for v in m.getVars()], m.objVal - reactant.formation_energy_per_atom
 
 
-def find_greedy_old_first_choices(reactant: Compound, products: list[Compound], for_oxide: bool, firstk: int = None):
+def find_lp_batch(pairs: list[Tuple[Compound, list[Compound]]]) -> list[Tuple[list[float], float]]:
+    """
+    solve many independent pairs in one block-diagonal LP, the blocks share no variable or constraint,
+    so the optimum of each block is the optimum of `find_lp` for that pair
+
+    if the LP of a pair has multiple optima, `sol` may be a different optimum than that of `find_lp`,
+    `dh` is always the same. If the batch cannot be solved to optimality (e.g. one pair is infeasible),
+    every pair is solved with `find_lp` instead.
+
+    :param pairs: a list of (reactant, products)
+    :return: a list of (sol, dh) in the same order as `pairs`
+    """
+    results = [None, ] * len(pairs)
+    with gp.Env(empty=True) as env:
+        env.setParam('OutputFlag', 0)
+        env.setParam('LogToConsole', 0)
+        env.start()
+        with gp.Model(env=env) as m:
+            blocks = []
+            objective = gp.LinExpr()
+            for ipair, (reactant, products) in enumerate(pairs):
+                if len(products) == 0:
+                    results[ipair] = [], - reactant.formation_energy_per_atom
+                    continue
+                elements_in_products = set()
+                for product in products:
+                    elements_in_products.update(product.elements)
+                elements_in_constraints = sorted(set(reactant.elements).intersection(elements_in_products))
+
+                # variables are non-negative by default
+                x = [m.addVar(name="{}_{}".format(ipair, iproduct)) for iproduct in range(len(products))]
+                for e in elements_in_constraints:
+                    coeffs = []
+                    x_e = []
+                    for x_i, product in zip(x, products):
+                        if e in product.normalized_formula:
+                            coeffs.append(product.normalized_formula[e])
+                            x_e.append(x_i)
+                    m.addLConstr(gp.LinExpr(coeffs, x_e), GRB.EQUAL, reactant.normalized_formula[e],
+                                 name="{}_{}".format(ipair, e))
+                objective.addTerms([product.formation_energy_per_atom for product in products], x)
+                blocks.append((ipair, x))
+
+            if len(blocks) == 0:
+                return results
+            m.setObjective(objective, GRB.MINIMIZE)
+            m.optimize()
+            if m.Status != GRB.OPTIMAL:
+                return [find_lp(reactant, products) for reactant, products in pairs]
+            values = m.getAttr("X", m.getVars())
+
+    ivalue = 0
+    for ipair, x in blocks:
+        reactant, products = pairs[ipair]
+        sol = values[ivalue:ivalue + len(x)]
+        ivalue += len(x)
+        enthalpy = sum(x_i * product.formation_energy_per_atom for x_i, product in zip(sol, products))
+        results[ipair] = sol, enthalpy - reactant.formation_energy_per_atom
+    return results
+
+
+def search_first_choices(
+        find_one: Callable[[int], Tuple[list[float], float]], reactant: Compound, products: list[Compound],
+        firstk: int = None, time_budget: float = None,
+) -> Tuple[list[float], float, int, bool]:
+    """
+    try first choices and keep the best solution,
+    `first_choice` is the position in the initial ranking, so first choices are tried from the most favored one
+
+    :param find_one: solve the pair with a given first choice
+    :param firstk: how many first choices to try, default all choices
+    :param time_budget: seconds allowed for the search, the most favored first choice is always tried,
+        then no first choice is started after the deadline, default no limit
+    :return: (sol, dh, number of first choices tried, if all `firstk` first choices were tried)
+    """
     dh_min = np.inf
     sol_min = None
     if firstk == None:
         first_choices = range(len(products))
     else:
         first_choices = range(min([len(products), firstk]))
+    deadline = None if time_budget is None else time.perf_counter() + time_budget
+    n_explored = 0
     for i in first_choices:
-        sol, dh = find_greedy_old(reactant, products, first_choice=i, for_oxide=for_oxide)
+        if n_explored > 0 and deadline is not None and time.perf_counter() > deadline:
+            return sol_min, dh_min, n_explored, False
+        sol, dh = find_one(i)
+        n_explored += 1
         # check elemental conservation
         assert check_solution(sol, products, reactant)
         if dh < dh_min:
             dh_min = dh
             sol_min = sol
-    return sol_min, dh_min
+    return sol_min, dh_min, n_explored, True
+
+
+def find_greedy_old_first_choices(reactant: Compound, products: list[Compound], for_oxide: bool, firstk: int = None,
+                                  reactive_species: tuple[str, ...] = None, time_budget: float = None,
+                                  return_search_info: bool = False):
+    """
+    :param time_budget: seconds allowed for trying first choices, see `search_first_choices`
+    :param return_search_info: if True, return (sol, dh, number of first choices tried, if the search finished)
+    """
+    result = search_first_choices(
+        lambda i: find_greedy_old(reactant, products, first_choice=i, for_oxide=for_oxide,
+                                  reactive_species=reactive_species),
+        reactant, products, firstk=firstk, time_budget=time_budget
+    )
+    return result if return_search_info else result[:2]
 
 
 def find_greedy_first_choices(
         reactant: Compound, products: list[Compound],
-        diligent_greedy: bool, for_oxide: bool, firstk: int = None,
+        diligent_greedy: bool, for_oxide: bool, firstk: int = None, reactive_species: tuple[str, ...] = None,
+        time_budget: float = None, return_search_info: bool = False,
 ):
-    dh_min = np.inf
-    sol_min = None
-    if firstk == None:
-        first_choices = range(len(products))
-    else:
-        first_choices = range(min([len(products), firstk]))
-    for i in first_choices:
-        sol, dh = find_greedy(reactant, products, first_choice=i, diligent_greedy=diligent_greedy, for_oxide=for_oxide)
-        # check elemental conservation
-        assert check_solution(sol, products, reactant)
-        if dh < dh_min:
-            dh_min = dh
-            sol_min = sol
-    return sol_min, dh_min
+    """
+    :param time_budget: seconds allowed for trying first choices, see `search_first_choices`
+    :param return_search_info: if True, return (sol, dh, number of first choices tried, if the search finished)
+    """
+    result = search_first_choices(
+        lambda i: find_greedy(reactant, products, first_choice=i, diligent_greedy=diligent_greedy,
+                              for_oxide=for_oxide, reactive_species=reactive_species),
+        reactant, products, firstk=firstk, time_budget=time_budget
+    )
+    return result if return_search_info else result[:2]
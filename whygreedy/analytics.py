@@ -0,0 +1,176 @@
+from array import array
+from typing import Iterable, Tuple
+
+import numpy as np
+
+from whygreedy.schema import Compound
+
+"""
+compare methods on combined records as numpy arrays,
+records are read once and only scalars are kept, so full result sets fit in memory
+
+a record has `dh_<method>` and `sol_<method>` for each method, e.g. `dh_lp` and `sol_lazy_f3` from `combine.py`,
+records from `calculate.py` (`dh` and `sol`) are read as method `""`
+"""
+
+
+def get_methods(record: dict) -> list[str]:
+    return sorted(k[3:] for k in record if k.startswith("dh_")) or [""]
+
+
+def records_to_arrays(
+        records: Iterable[dict], pairs: Iterable[Tuple[Compound, list[Compound]]] = None, eps: float = 1e-5,
+) -> dict[str, np.ndarray]:
+    """
+    read records (and the pairs in the same order) to columns
+
+    - `dh_<method>`: reaction enthalpy, inf if the method found no solution, e.g. greedy with no products
+    - `nnz_<method>`: number of products with x_i > eps, a solution of None uses no products
+    - `support_<method>`: hash of the indices of products with x_i > eps, used to find qualitative differences
+    - `n_products`: number of products, the longest solution if `pairs` is not given
+    - `n_elements`, `chemsys` (if `pairs` is given): number of elements and chemical system of the reactant
+
+    :param records: combined records, can be a generator
+    :param pairs: the pairs, can be a generator, must be in the same order as `records`
+    :param eps: x_i smaller than this is zero
+    :return: a dictionary of column name -> 1d array
+    """
+    columns = None
+    methods = None
+    chemsys = []
+    pairs = iter(pairs) if pairs is not None else None
+    for record in records:
+        if columns is None:
+            methods = get_methods(record)
+            columns = {"n_products": array("q")}
+            for method in methods:
+                columns[_key("dh", method)] = array("d")
+                columns[_key("nnz", method)] = array("q")
+                columns[_key("support", method)] = array("q")
+            if pairs is not None:
+                columns["n_elements"] = array("q")
+        n_products = 0
+        for method in methods:
+            sol = record[_key("sol", method)]
+            sol = np.zeros(0) if sol is None else np.asarray(sol, dtype=float)
+            support = np.flatnonzero(np.abs(sol) > eps)
+            columns[_key("dh", method)].append(record[_key("dh", method)])
+            columns[_key("nnz", method)].append(len(support))
+            columns[_key("support", method)].append(hash(support.tobytes()))
+            n_products = max(n_products, len(sol))
+        if pairs is not None:
+            reactant, products = next(pairs)
+            n_products = len(products)
+            columns["n_elements"].append(len(reactant.elements))
+            chemsys.append("-".join(reactant.elements))
+        columns["n_products"].append(n_products)
+    if columns is None:
+        return dict()
+    arrays = {k: np.frombuffer(v, dtype=np.float64 if v.typecode == "d" else np.int64) for k, v in columns.items()}
+    if pairs is not None:
+        arrays["chemsys"] = np.array(chemsys)
+    return arrays
+
+
+def _key(prefix: str, method: str) -> str:
+    return prefix if method == "" else "{}_{}".format(prefix, method)
+
+
+def group_reduce(values: np.ndarray, groups: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    count, mean, std, min, max, median of `values` in each group, groups are sorted
+
+    :return: a dictionary of column name -> 1d array, `group` is the group values
+    """
+    order = np.argsort(groups, kind="stable")
+    sorted_groups = groups[order]
+    sorted_values = values[order]
+    unique, starts, counts = np.unique(sorted_groups, return_index=True, return_counts=True)
+    sums = np.add.reduceat(sorted_values, starts) if len(values) > 0 else np.zeros(0)
+    means = sums / np.maximum(counts, 1)
+    sq = np.add.reduceat((sorted_values - np.repeat(means, counts)) ** 2, starts) if len(values) > 0 else np.zeros(0)
+    # median of each group, sort values within groups
+    order_in_group = np.lexsort((sorted_values, np.repeat(np.arange(len(unique)), counts)))
+    values_in_group = sorted_values[order_in_group]
+    lo = starts + (counts - 1) // 2
+    hi = starts + counts // 2
+    return dict(
+        group=unique,
+        count=counts,
+        mean=means,
+        std=np.sqrt(sq / np.maximum(counts, 1)),
+        min=np.minimum.reduceat(sorted_values, starts) if len(values) > 0 else np.zeros(0),
+        max=np.maximum.reduceat(sorted_values, starts) if len(values) > 0 else np.zeros(0),
+        median=(values_in_group[lo] + values_in_group[hi]) / 2,
+    )
+
+
+def compare_methods(
+        arrays: dict[str, np.ndarray], a: str, b: str, by: str = None, eps: float = 1e-5
+) -> dict[str, np.ndarray]:
+    """
+    compare method `a` against method `b`, e.g. `lp` vs `lazy_f3` or `diligent` vs `lazy`,
+    the gap is dh_a - dh_b, a negative gap means `a` is better
+
+    :param arrays: from `records_to_arrays`
+    :param by: a column to group by, e.g. `n_elements`, `n_products`, `chemsys`, None for all records
+    :param eps: gaps smaller than this are zero
+    :return: a dictionary of column name -> 1d array, one row per group
+        - `count`: number of records
+        - `n_invalid`: number of records where either dh is not finite, e.g. greedy with no products,
+          these are left out of all other counts and gaps
+        - `n_a_better`, `n_b_better`: number of records where a (b) is lower by more than `eps`
+        - `n_qualitative_diff`: number of records where the products used are different
+        - `mean_gap`, `min_gap`: over valid records, min is the largest improvement of a over b,
+          nan if a group has no valid records
+        - `mean_nonzero_gap`: over records with nonzero gaps
+    """
+    with np.errstate(invalid="ignore"):
+        gap = arrays[_key("dh", a)] - arrays[_key("dh", b)]
+    if by is None:
+        groups = np.zeros(len(gap), dtype=int)
+    else:
+        groups = arrays[by]
+    unique, inverse, counts = np.unique(groups, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    valid = np.isfinite(gap)
+    n_valid = np.bincount(inverse, weights=valid, minlength=len(unique))
+    valid_gap = np.where(valid, gap, 0)
+    min_gap = np.full(len(unique), np.inf)
+    np.minimum.at(min_gap, inverse[valid], gap[valid])
+    nonzero = valid & (np.abs(valid_gap) > eps)
+    n_nonzero = np.bincount(inverse, weights=nonzero, minlength=len(unique))
+    summary_compare = dict(
+        group=unique,
+        count=counts,
+        n_invalid=counts - n_valid.astype(int),
+        n_a_better=np.bincount(inverse, weights=valid & (valid_gap < -eps), minlength=len(unique)).astype(int),
+        n_b_better=np.bincount(inverse, weights=valid & (valid_gap > eps), minlength=len(unique)).astype(int),
+        n_qualitative_diff=np.bincount(
+            inverse, weights=valid & (arrays[_key("support", a)] != arrays[_key("support", b)]),
+            minlength=len(unique)
+        ).astype(int),
+        mean_gap=np.where(n_valid > 0, np.bincount(inverse, weights=valid_gap, minlength=len(unique)) /
+                          np.maximum(n_valid, 1), np.nan),
+        min_gap=np.where(n_valid > 0, min_gap, np.nan),
+        mean_nonzero_gap=np.bincount(inverse, weights=np.where(nonzero, gap, 0), minlength=len(unique)) /
+                         np.maximum(n_nonzero, 1),
+    )
+    summary_compare["frac_a_better"] = summary_compare["n_a_better"] / summary_compare["count"]
+    return summary_compare
+
+
+def bin_column(arrays: dict[str, np.ndarray], column: str, edges: list[float]) -> np.ndarray:
+    """
+    bin a numeric column, e.g. `n_products` with edges [1, 2, 5, 10, 50], the bin is the lower edge
+    """
+    edges = np.asarray(edges)
+    return edges[np.clip(np.digitize(arrays[column], edges) - 1, 0, len(edges) - 1)]
+
+
+def to_rows(summary: dict[str, np.ndarray]) -> list[dict]:
+    """
+    columns to rows of python scalars, e.g. for json
+    """
+    keys = list(summary.keys())
+    return [{k: summary[k][i].item() for k in keys} for i in range(len(summary[keys[0]]))]
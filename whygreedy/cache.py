@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+from typing import Union
+
+from whygreedy.index import ChemsysIndex
+from whygreedy.mp import mpdata, load_mp, mpdata_to_compound, find_environment_pairs_from_compounds
+from whygreedy.schema import Compound
+from whygreedy.utils import file_type, file_exists, pkl_dump, pkl_load, pkl_dump_pairs, pairs_meta_path
+
+"""
+a content-addressed cache of pairs, an artifact is keyed by
+the hash of `mp.json.gz`, the reaction type and the filter parameters,
+so a changed source file or criteria never picks up stale pairs.
+The cleaned compounds are cached as an intermediate shared by all reaction types,
+and in one process the compounds, the filtered sets, their indexes and pairs are kept in memory across calls.
+"""
+
+# bump this when the pair builders change in a way that changes the pairs, or the format of the artifacts,
+# 2: pairs are written in chunks with a sidecar, see `_atomic_pkl_dump_pairs`
+PAIRS_VERSION = 2
+
+# pairs per pickle in a pairs artifact, a reader holds one chunk at a time,
+# larger chunks share more of the pickle memo (a smaller file, e.g. 1.6x a single pickle at 1000, 1.2x at 5000)
+PAIRS_CHUNK_SIZE = 1000
+
+# e_above_hull (meV) criteria used by default, None for all compounds, same as `load_mp_*_pairs`
+DEFAULT_CRITERIA = {
+    "oxidation": 50,
+    "decomposition": None,
+}
+
+
+def get_default_criteria(reaction_type: str) -> Union[float, None]:
+    return DEFAULT_CRITERIA.get(reaction_type, 50)
+
+
+def sha256_file(fn: file_type, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_params(params: dict) -> str:
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+class PairCache:
+
+    def __init__(self, cache_dir: file_type, mp_json: file_type = mpdata):
+        """
+        :param cache_dir: folder of cached artifacts, created if not exists
+        :param mp_json: the source data downloaded by `data/downloader.py`
+        """
+        self.cache_dir = cache_dir
+        self.mp_json = mp_json
+        os.makedirs(cache_dir, exist_ok=True)
+        self._source_hash = None
+        self._mp_compounds = None
+        self._compounds = dict()
+        self._indexes = dict()
+        self._pairs = dict()
+
+    @property
+    def source_hash(self) -> str:
+        """
+        sha256 of the source data, remembered by its path, size and mtime to avoid hashing it every time
+        """
+        if self._source_hash is None:
+            stat = os.stat(self.mp_json)
+            file_id = "{}:{}:{}".format(os.path.abspath(self.mp_json), stat.st_size, stat.st_mtime_ns)
+            known_hashes_json = os.path.join(self.cache_dir, "source_hashes.json")
+            known_hashes = dict()
+            if file_exists(known_hashes_json):
+                with open(known_hashes_json, "r") as f:
+                    known_hashes = json.load(f)
+            if file_id not in known_hashes:
+                known_hashes[file_id] = sha256_file(self.mp_json)
+                with open(known_hashes_json, "w") as f:
+                    json.dump(known_hashes, f, indent=2)
+            self._source_hash = known_hashes[file_id]
+        return self._source_hash
+
+    def artifact_path(self, kind: str, params: dict) -> str:
+        name = kind if "reaction_type" not in params else "{}_{}".format(kind, params["reaction_type"])
+        params = dict(params, source=self.source_hash, version=PAIRS_VERSION, kind=kind)
+        return os.path.join(self.cache_dir, "{}_{}.pkl".format(name, hash_params(params)))
+
+    def get_mp_compounds(self) -> list[Compound]:
+        """
+        all clean compounds in the source data, `e_above_hull` is kept in `properties`
+        """
+        if self._mp_compounds is None:
+            fn = self.artifact_path("compounds", {})
+            if file_exists(fn):
+                self._mp_compounds = pkl_load(fn)
+            else:
+                compounds = []
+                for d in load_mp(self.mp_json):
+                    c = mpdata_to_compound(d)
+                    c.properties["e_above_hull"] = d["e_above_hull"]
+                    compounds.append(c)
+                _atomic_pkl_dump(compounds, fn)
+                self._mp_compounds = compounds
+        return self._mp_compounds
+
+    def get_compounds(self, criteria: Union[float, None]) -> list[Compound]:
+        """
+        compounds with e_above_hull (meV) smaller than `criteria`, all compounds if `criteria` is None,
+        this is the same filter as `find_stable_compounds`
+        """
+        criteria = _normalize_criteria(criteria)
+        if criteria not in self._compounds:
+            compounds = self.get_mp_compounds()
+            if criteria is not None:
+                compounds = [c for c in compounds if abs(c.properties["e_above_hull"]) < criteria / 1000]
+            self._compounds[criteria] = compounds
+        return self._compounds[criteria]
+
+    def get_index(self, criteria: Union[float, None]) -> ChemsysIndex:
+        criteria = _normalize_criteria(criteria)
+        if criteria not in self._indexes:
+            self._indexes[criteria] = ChemsysIndex(self.get_compounds(criteria))
+        return self._indexes[criteria]
+
+    def get_environment_pairs(self, reaction_types: list[str], criteria: Union[float, None, str] = "default") -> dict:
+        """
+        pairs of several reaction types, the ones not cached are built in one pass
+
+        :param reaction_types: keys of `REACTIVE_SPECIES`
+        :param criteria: e_above_hull (meV) criteria, None for all compounds,
+            "default" to use `DEFAULT_CRITERIA` of each reaction type
+        :return: a dictionary of reaction type -> pairs
+        """
+        pairs = dict()
+        to_build = dict()
+        for reaction_type in reaction_types:
+            reaction_criteria = get_default_criteria(reaction_type) if criteria == "default" else criteria
+            reaction_criteria = _normalize_criteria(reaction_criteria)
+            fn = self.pairs_path(reaction_type, reaction_criteria)
+            if fn in self._pairs:
+                pairs[reaction_type] = self._pairs[fn]
+            elif file_exists(fn):
+                print("found cached pairs: {}".format(fn))
+                pairs[reaction_type] = self._pairs[fn] = pkl_load(fn)
+            else:
+                try:
+                    to_build[reaction_criteria].append(reaction_type)
+                except KeyError:
+                    to_build[reaction_criteria] = [reaction_type, ]
+        for reaction_criteria, reaction_types_to_build in to_build.items():
+            built = find_environment_pairs_from_compounds(self.get_compounds(reaction_criteria),
+                                                          reaction_types_to_build,
+                                                          index=self.get_index(reaction_criteria))
+            for reaction_type in reaction_types_to_build:
+                fn = self.pairs_path(reaction_type, reaction_criteria)
+                _atomic_pkl_dump_pairs(built[reaction_type], fn)
+                pairs[reaction_type] = self._pairs[fn] = built[reaction_type]
+        return pairs
+
+    def get_pairs(self, reaction_type: str, criteria: Union[float, None, str] = "default"):
+        return self.get_environment_pairs([reaction_type, ], criteria)[reaction_type]
+
+    def pairs_path(self, reaction_type: str, criteria: Union[float, None]) -> str:
+        return self.artifact_path("pairs", {"reaction_type": reaction_type, "criteria": _normalize_criteria(criteria)})
+
+
+def _normalize_criteria(criteria: Union[float, None]) -> Union[float, None]:
+    # 50 and 50.0 are the same key
+    return None if criteria is None else float(criteria)
+
+
+def _atomic_pkl_dump(o, fn: str):
+    # a killed run never leaves a truncated artifact behind
+    tmp = "{}.tmp".format(fn)
+    pkl_dump(o, tmp)
+    os.replace(tmp, fn)
+
+
+def _atomic_pkl_dump_pairs(pairs: list, fn: str):
+    # pairs are written in chunks so `calculate.py` streams them, the sidecar gives their number and sizes
+    tmp = "{}.tmp".format(fn)
+    chunks = [pairs[i:i + PAIRS_CHUNK_SIZE] for i in range(0, len(pairs), PAIRS_CHUNK_SIZE)]
+    # an empty file is not a cached artifact, see `file_exists`
+    pkl_dump_pairs(chunks if len(chunks) > 0 else [[], ], tmp)
+    os.replace(pairs_meta_path(tmp), pairs_meta_path(fn))
+    os.replace(tmp, fn)
@@ -1,40 +1,419 @@
-from typing import Tuple, Callable
+import copy
+import multiprocessing
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Executor, wait, FIRST_COMPLETED
+from typing import Tuple, Callable, Iterable, Iterator
 
-from pqdm.processes import pqdm
 from tqdm import tqdm
 
-from whygreedy.schema import Compound
+from whygreedy.algo import find_greedy_first_choices, find_greedy_old_first_choices, find_lp, find_lp_batch
+from whygreedy.fastpath import find_closed_form
+from whygreedy.prune import HullPruner, expand_solution
+from whygreedy.schema import Compound, REACTIVE_SPECIES
+from whygreedy.telemetry import Telemetry, get_peak_rss
+from whygreedy.utils import file_type
+
+
+def get_cal_function(
+        method: str, reaction_type: str, firstk: int = None, time_budget: float = None
+) -> Tuple[Callable, dict]:
+    """
+    get the function and its kwargs used to minimize delta H
+
+    :param method: lazy, diligent, lp
+    :param reaction_type: one of `REACTIVE_SPECIES`, e.g. oxidation, decomposition
+    :param firstk: how many different first choices to try in a greedy algorithm, default all choices
+    :param time_budget: seconds allowed for trying first choices of a pair in a greedy algorithm, default no limit
+    :return: (cal_function, cal_function_kwargs)
+    """
+    cal_function_kwargs = {}
+    if reaction_type == "oxidation":
+        cal_function_kwargs["for_oxide"] = True
+    elif reaction_type == "decomposition":
+        cal_function_kwargs["for_oxide"] = False
+    elif reaction_type in REACTIVE_SPECIES:
+        cal_function_kwargs["for_oxide"] = False
+        cal_function_kwargs["reactive_species"] = REACTIVE_SPECIES[reaction_type]
+    else:
+        raise ValueError("reaction_type is: {}".format(reaction_type))
+
+    if method == "lazy" and "reactive_species" in cal_function_kwargs:
+        raise ValueError("this cannot be done: method=={}, reaction_type=={}".format(method, reaction_type))
+    if method == "lp" and time_budget is not None:
+        raise ValueError("time_budget can only be used with greedy algorithms, but method is: {}".format(method))
+    if time_budget is not None:
+        cal_function_kwargs["time_budget"] = time_budget
+    if method == "lazy":
+        cal_function = find_greedy_old_first_choices
+        cal_function_kwargs["firstk"] = firstk
+    elif method == "diligent":
+        cal_function = find_greedy_first_choices
+        cal_function_kwargs["diligent_greedy"] = True
+        cal_function_kwargs["firstk"] = firstk
+    elif method == "lp":
+        cal_function = find_lp
+        cal_function_kwargs = {}  # this does not take any kwarg
+    else:
+        raise ValueError("method is: {}".format(method))
+    return cal_function, cal_function_kwargs
+
+
+# set in each worker process of a process pool by `_init_worker`
+_worker_state = dict()
+
+
+def _init_worker(events):
+    _worker_state["events"] = events
+
+
+def get_worker_id() -> str:
+    return "{}:{}".format(os.getpid(), threading.current_thread().name)
+
+
+def report_start(telemetry: Telemetry, worker: str, n: int = 1):
+    """
+    report pairs started by a worker, directly if `telemetry` is in this process, otherwise through the queue
+    of the process pool
+    """
+    if telemetry is not None:
+        telemetry.start(worker, n=n)
+    elif _worker_state.get("events") is not None:
+        ts = time.time()
+        for _ in range(n):
+            _worker_state["events"].put((worker, ts))
 
 
 class Calculator:
     def __init__(self, pairs: list[Tuple[Compound, list[Compound]]], name: str,
-                 cal_function: Callable, cal_function_kwargs: dict):
+                 cal_function: Callable, cal_function_kwargs: dict, fast_path: bool = False,
+                 telemetry_file: file_type = None, telemetry_interval: float = 5.0, telemetry_label: str = None,
+                 prune: bool = False):
+        """
+        :param fast_path: if True, degenerate pairs are solved in closed form, see `whygreedy.fastpath`,
+            the path taken by each pair is recorded as `path`
+        :param telemetry_file: if given, live metrics are written to this file, see `whygreedy.telemetry`
+        :param telemetry_interval: min seconds between two snapshots of metrics
+        :param telemetry_label: label of the method in metrics, default to the name of `cal_function`
+        :param prune: LP only, remove products above the lower hull of their chemical system before solving,
+            see `whygreedy.prune`, the number of products kept is recorded as `n_products_kept`
+        """
         self.pairs = pairs
         self.name = name
         self.cal_function = cal_function
         self.cal_function_kwargs = cal_function_kwargs
+        self.fast_path = fast_path
+        self.telemetry_file = telemetry_file
+        self.telemetry_interval = telemetry_interval
+        if telemetry_label is None:
+            telemetry_label = cal_function.__name__
+        self.telemetry_label = telemetry_label
+        if prune and cal_function is not find_lp:
+            raise ValueError("pruning can only be used with LP, but cal_function is: {}".format(cal_function.__name__))
+        self.pruner = HullPruner() if prune else None
+        self._telemetry = None
 
     def cal_serial(self, k: int = None):
         if k is None:
             pairs = self.pairs
         else:
             pairs = self.pairs[:k]
+        telemetry = self.start_telemetry(pairs)
         records = []
-        for p in tqdm(pairs):
-            record = self.cal_one(p)
-            records.append(record)
+        try:
+            for p in tqdm(pairs):
+                record, worker, busy, peak_rss = self.cal_one_timed(p)
+                records.append(record)
+                if telemetry is not None:
+                    telemetry.update(worker, busy, self.pair_cost(p), peak_rss=peak_rss)
+        finally:
+            self.stop_telemetry(telemetry)
         return records
 
-    def cal_one(self, p):
+    def pair_cost(self, p) -> float:
+        """
+        a rough estimate of the time needed to solve a pair, in arbitrary unit
+        """
+        return self.n_products_cost(len(p[1]))
+
+    def n_products_cost(self, n: int) -> float:
+        """
+        `pair_cost` of a pair with `n` products, e.g. to get the total cost from `load_pairs_meta`
+        """
+        if self.cal_function is find_lp:
+            return n + 1
+        firstk = self.cal_function_kwargs.get("firstk", None)
+        n_first_choices = n if firstk is None else min(n, firstk)
+        return max(n_first_choices, 1) * (n + 1)
+
+    def start_telemetry(self, pairs: list = None, total: int = None, total_cost: float = None) -> Telemetry or None:
+        """
+        start writing metrics with a heartbeat, workers in this process report the pairs they start to it
+
+        :param pairs: pairs to be calculated, None if they are streamed
+        :param total: number of streamed pairs if known
+        :param total_cost: cost of streamed pairs if known, there is no ETA without it
+        """
+        if self.telemetry_file is None:
+            return None
+        if pairs is not None:
+            total = len(pairs)
+            total_cost = sum(self.pair_cost(p) for p in pairs)
+        telemetry = Telemetry(self.telemetry_file, method=self.telemetry_label, total=total, total_cost=total_cost,
+                              interval=self.telemetry_interval)
+        telemetry.start_heartbeat()
+        self._telemetry = telemetry
+        return telemetry
+
+    def stop_telemetry(self, telemetry: Telemetry = None):
+        if telemetry is not None:
+            telemetry.close()
+        self._telemetry = None
+
+    def cal_one_timed(self, p, kept: list[int] = None):
+        """
+        `cal_one` with the worker id, the seconds spent and the peak rss of the worker
+        """
+        worker = get_worker_id()
+        report_start(self._telemetry, worker)
+        ts1 = time.perf_counter()
+        record = self.cal_one(p, kept)
+        ts2 = time.perf_counter()
+        return record, worker, ts2 - ts1, get_peak_rss()
+
+    def cal_one(self, p, kept: list[int] = None):
+        """
+        :param kept: indices of the products kept if the pair is already pruned, e.g. by the parent of a process pool
+        """
+        if kept is None and self.pruner is not None:
+            kept = self.pruner.prune(*p)
+        reactant, products = self.pruned_pair(p, kept)
+        path = None
+        result = None
+        if self.fast_path:
+            path, result = find_closed_form(reactant, products, exact=self.cal_function is find_lp,
+                                            for_oxide=self.cal_function_kwargs.get("for_oxide", True),
+                                            reactive_species=self.cal_function_kwargs.get("reactive_species", None))
+        if result is None and "time_budget" in self.cal_function_kwargs:
+            # anytime search, also record how far it went
+            sol, dh, n_explored, finished = self.cal_function(reactant=reactant, products=products,
+                                                              return_search_info=True, **self.cal_function_kwargs)
+            record = self.make_record(p, sol, dh, path=path)
+            record["n_explored"] = n_explored
+            record["finished"] = finished
+            return record
+        if result is None:
+            result = self.cal_function(reactant=reactant, products=products, **self.cal_function_kwargs)
+        return self.make_pruned_record(p, kept, *result, path=path)
+
+    @staticmethod
+    def pruned_pair(p, kept: list[int] = None):
+        if kept is None:
+            return p
+        return p[0], [p[1][i] for i in kept]
+
+    def make_pruned_record(self, p, kept: list[int], sol: list[float], dh: float, path: str = None) -> dict:
+        """
+        `make_record` with the solution over the kept products mapped back to the original products
+        """
+        if kept is None:
+            return self.make_record(p, sol, dh, path=path)
+        record = self.make_record(p, expand_solution(sol, kept, len(p[1])), dh, path=path)
+        record["n_products_kept"] = len(kept)
+        return record
+
+    @staticmethod
+    def count_pruned(records: list[dict]) -> dict:
+        """
+        how much the problem size shrank by pruning
+        """
+        n_before = sum(len(record["products"]) for record in records)
+        n_after = sum(record.get("n_products_kept", len(record["products"])) for record in records)
+        return dict(n_products_before=n_before, n_products_after=n_after,
+                    fraction_removed=1 - n_after / n_before if n_before > 0 else 0.0)
+
+    @staticmethod
+    def count_unfinished(records: list[dict]) -> int:
+        """
+        how many pairs ran out of time before trying all first choices
+        """
+        return sum(not record.get("finished", True) for record in records)
+
+    @staticmethod
+    def make_record(p, sol: list[float], dh: float, path: str = None) -> dict:
         reactant, products = p
-        sol, dh = self.cal_function(reactant=reactant, products=products, **self.cal_function_kwargs)
-        return dict(
+        record = dict(
             sol=sol, dh=dh,
             reactant=reactant.mpid,
             products=[prod.mpid for prod in products]
         )
+        if path is not None:
+            record["path"] = path
+        return record
 
-    def cal_parallel(self, n_jobs=8):
+    def cal_batched(self, batch_size: int = 200, n_jobs: int = 1):
+        """
+        solve pairs in batches of block-diagonal LPs with `find_lp_batch`,
+        batches are solved by a thread pool if `n_jobs` > 1
+
+        :param batch_size: number of pairs in one LP
+        :param n_jobs: number of threads
+        """
+        if self.cal_function is not find_lp:
+            raise ValueError("batched calculation is only for LP, but cal_function is: {}".format(
+                self.cal_function.__name__))
         pairs = self.pairs
-        records = pqdm(pairs, self.cal_one, n_jobs=n_jobs)
+        records = [None, ] * len(pairs)
+        kept = [None, ] * len(pairs)
+        batches = [[]]
+        for i, p in enumerate(pairs):
+            if self.pruner is not None:
+                kept[i] = self.pruner.prune(*p)
+            if self.fast_path:
+                path, result = find_closed_form(*self.pruned_pair(p, kept[i]), exact=True)
+                if result is not None:
+                    records[i] = self.make_pruned_record(p, kept[i], *result, path=path)
+                    continue
+            if len(batches[-1]) == batch_size:
+                batches.append([])
+            batches[-1].append(i)
+
+        def cal_batch(batch: list[int]):
+            batch_pairs = [self.pruned_pair(pairs[i], kept[i]) for i in batch]
+            for i, result in zip(batch, find_lp_batch(batch_pairs)):
+                records[i] = self.make_pruned_record(pairs[i], kept[i], *result,
+                                                     path="general" if self.fast_path else None)
+            return len(batch)
+
+        telemetry = self.start_telemetry(pairs)
+        try:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor, tqdm(total=len(pairs)) as pbar:
+                pbar.update(len(pairs) - sum(len(batch) for batch in batches))
+                futures = [executor.submit(self._cal_batch_timed, cal_batch, batch) for batch in batches]
+                for ibatch, future in enumerate(futures):
+                    n, worker, busy = future.result()
+                    pbar.update(n)
+                    if telemetry is not None:
+                        telemetry.update(worker, busy, sum(self.pair_cost(pairs[i]) for i in batches[ibatch]), n=n,
+                                         queue_depth=sum(len(batch) for batch in batches[ibatch + 1:]),
+                                         peak_rss=get_peak_rss())
+        finally:
+            self.stop_telemetry(telemetry)
         return records
+
+    def _cal_batch_timed(self, cal_batch: Callable, batch: list[int]):
+        worker = get_worker_id()
+        report_start(self._telemetry, worker, n=len(batch))
+        ts1 = time.perf_counter()
+        n = cal_batch(batch)
+        ts2 = time.perf_counter()
+        return n, worker, ts2 - ts1
+
+    @staticmethod
+    def count_paths(records: list[dict]) -> Counter:
+        """
+        how many pairs are solved in closed form (by type) or by the general solvers
+        """
+        return Counter(record.get("path", "general") for record in records)
+
+    def cal_parallel(self, n_jobs=8):
+        return self._cal_pool(n_jobs, threads=False)
+
+    def cal_threaded(self, n_jobs=8):
+        """
+        solve pairs with a thread pool, nothing is pickled and the pairs are shared by threads,
+        this relies on the solvers being side-effect free
+        """
+        return self._cal_pool(n_jobs, threads=True)
+
+    def cal_stream(self, pairs: Iterable, n_jobs: int = 1, threads: bool = False, total: int = None,
+                   total_cost: float = None, max_pending_per_job: int = 16) -> Iterator[dict]:
+        """
+        solve pairs from an iterable and yield records in order, `self.pairs` is not used,
+        at most `n_jobs * max_pending_per_job` pairs are held at once, so pairs can be streamed from a file
+        and records to another without having either in memory
+
+        :param pairs: pairs, can be a generator
+        :param n_jobs: number of workers, 1 to solve in the calling thread
+        :param threads: use a thread pool instead of processes
+        :param total: number of pairs if known, for the progress bar and telemetry
+        :param total_cost: sum of `pair_cost` of the pairs if known, for the ETA in telemetry
+        """
+        telemetry = self.start_telemetry(total=total, total_cost=total_cost)
+        try:
+            if n_jobs == 1:
+                for p in tqdm(pairs, total=total):
+                    record, worker, busy, peak_rss = self.cal_one_timed(p)
+                    if telemetry is not None:
+                        telemetry.update(worker, busy, self.pair_cost(p), peak_rss=peak_rss)
+                    yield record
+            elif threads:
+                yield from self._cal_pool_stream(ThreadPoolExecutor(max_workers=n_jobs), self, n_jobs, pairs,
+                                                 telemetry, total, max_pending_per_job)
+            else:
+                executor, worker = self._process_pool(n_jobs, telemetry)
+                yield from self._cal_pool_stream(executor, worker, n_jobs, pairs, telemetry, total,
+                                                 max_pending_per_job)
+        finally:
+            self.stop_telemetry(telemetry)
+
+    def _cal_pool(self, n_jobs: int, threads: bool, max_pending_per_job: int = 16):
+        pairs = self.pairs
+        return list(self.cal_stream(pairs, n_jobs=n_jobs, threads=threads, total=len(pairs),
+                                    total_cost=sum(self.pair_cost(p) for p in pairs),
+                                    max_pending_per_job=max_pending_per_job))
+
+    def _process_pool(self, n_jobs: int, telemetry: Telemetry = None) -> Tuple[Executor, "Calculator"]:
+        """
+        a process pool and the copy of this calculator sent to it,
+        workers report the pairs they start to `telemetry` through a queue
+        """
+        # workers do not need the pairs, they are sent one at a time
+        worker = copy.copy(self)
+        worker.pairs = []
+        worker._telemetry = None
+        # pairs are pruned in this process, a pruner sent along would be pickled with every pair
+        # and its cache and counts would never come back
+        worker.pruner = None
+        events = None
+        if telemetry is not None:
+            events = multiprocessing.Queue()
+            telemetry.events = events
+        return ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(events,)), worker
+
+    def _cal_pool_stream(self, executor: Executor, worker, n_jobs: int, pairs: Iterable, telemetry: Telemetry,
+                         total: int = None, max_pending_per_job: int = 16) -> Iterator[dict]:
+        """
+        submit pairs to the executor with a bounded number of pairs in flight, records are yielded in order,
+        a record finished early waits for the ones before it and counts as in flight
+        """
+        prune_here = self.pruner is not None and worker.pruner is None
+        to_submit = iter(enumerate(pairs))
+        window = n_jobs * max_pending_per_job
+        pending = dict()
+        finished = dict()
+        i_next = 0
+        with executor, tqdm(total=total) as pbar:
+            while True:
+                if len(pending) + len(finished) < window:
+                    for i, p in to_submit:
+                        kept = self.pruner.prune(*p) if prune_here else None
+                        pending[executor.submit(worker.cal_one_timed, p, kept)] = (i, p)
+                        if len(pending) + len(finished) >= window:
+                            break
+                if len(pending) == 0:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, p = pending.pop(future)
+                    record, worker_id, busy, peak_rss = future.result()
+                    finished[i] = record
+                    pbar.update(1)
+                    if telemetry is not None:
+                        telemetry.update(worker_id, busy, self.pair_cost(p), queue_depth=len(pending),
+                                         peak_rss=peak_rss)
+                while i_next in finished:
+                    yield finished.pop(i_next)
+                    i_next += 1
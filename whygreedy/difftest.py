@@ -0,0 +1,166 @@
+import random
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Tuple, Callable, Optional
+
+import numpy as np
+
+from whygreedy.schema import Compound
+
+"""
+differential testing of a candidate solver against a reference solver,
+e.g. a faster engine against `find_lp`, `find_greedy_first_choices` or `find_greedy_old_first_choices`
+
+pairs are split into chunks solved in parallel, chunks are checked in order so the reported divergence is
+always the first one no matter how many workers are used
+"""
+
+
+def sample_pairs(
+        pairs: list[Tuple[Compound, list[Compound]]], k: int, seed: int = 42
+) -> Tuple[list[int], list[Tuple[Compound, list[Compound]]]]:
+    """
+    sample `k` pairs, the same sample as `random.seed(seed); random.sample(range(len(pairs)), k)`,
+    the global random state is left untouched
+
+    :return: (indices, sampled pairs)
+    """
+    indices = random.Random(seed).sample(range(len(pairs)), min(k, len(pairs)))
+    return indices, [pairs[i] for i in indices]
+
+
+def compare_results(
+        reference: Tuple[list[float], float], candidate: Tuple[list[float], float],
+        atol_dh: float = 1e-6, atol_sol: Optional[float] = 1e-6,
+) -> Optional[str]:
+    """
+    compare two (sol, dh) results
+
+    :param atol_dh: absolute tolerance of delta H
+    :param atol_sol: absolute tolerance of each x_i, None to skip comparing solutions,
+        e.g. LP can have degenerate optima of the same delta H
+    :return: None if they agree, otherwise the reason: "dh", "length", "sol",
+        or "missing" if only one of them found a solution, e.g. greedy returns (None, inf) for a pair without products
+    """
+    sol_ref, dh_ref = reference
+    sol_can, dh_can = candidate
+    found_ref = sol_ref is not None and np.isfinite(dh_ref)
+    found_can = sol_can is not None and np.isfinite(dh_can)
+    if found_ref != found_can:
+        return "missing"
+    if not found_ref:
+        # neither found a solution
+        return None if dh_ref == dh_can else "dh"
+    if not np.isclose(dh_ref, dh_can, rtol=0, atol=atol_dh):
+        return "dh"
+    if atol_sol is None:
+        return None
+    if len(sol_ref) != len(sol_can):
+        return "length"
+    if not np.allclose(sol_ref, sol_can, rtol=0, atol=atol_sol):
+        return "sol"
+    return None
+
+
+def _diff_chunk(
+        pairs: list[Tuple[Compound, list[Compound]]], indices: list[int],
+        reference: Callable, reference_kwargs: dict, candidate: Callable, candidate_kwargs: dict, batch: bool,
+        atol_dh: float, atol_sol: Optional[float],
+) -> Optional[dict]:
+    # the first divergence in a chunk, module level so it can be sent to a process pool
+    if batch:
+        try:
+            candidate_results = candidate(pairs, **candidate_kwargs)
+        except Exception as e:
+            candidate_results = [e, ] * len(pairs)
+    for j, (reactant, products) in enumerate(pairs):
+        try:
+            reference_result = reference(reactant, products, **reference_kwargs)
+        except Exception as e:
+            return dict(
+                index=indices[j], reason="reference_error", reactant=reactant.normalized_formula,
+                n_products=len(products), reference=repr(e), candidate=None,
+            )
+        try:
+            if batch:
+                candidate_result = candidate_results[j]
+                if isinstance(candidate_result, Exception):
+                    raise candidate_result
+            else:
+                candidate_result = candidate(reactant, products, **candidate_kwargs)
+        except Exception as e:
+            reason = "error"
+            candidate_result = repr(e)
+        else:
+            reason = compare_results(reference_result, candidate_result, atol_dh, atol_sol)
+        if reason is not None:
+            return dict(
+                index=indices[j], reason=reason, reactant=reactant.normalized_formula, n_products=len(products),
+                reference=reference_result, candidate=candidate_result,
+            )
+    return None
+
+
+def find_first_divergence(
+        pairs: list[Tuple[Compound, list[Compound]]],
+        reference: Callable, candidate: Callable,
+        reference_kwargs: dict = None, candidate_kwargs: dict = None,
+        indices: list[int] = None, batch: bool = False,
+        atol_dh: float = 1e-6, atol_sol: Optional[float] = 1e-6,
+        n_jobs: int = 1, threads: bool = False, chunk_size: int = 20,
+) -> Optional[dict]:
+    """
+    run `candidate` next to `reference` and find the first pair where they diverge
+
+    :param pairs: the pairs to compare
+    :param reference: a solver of the signature `f(reactant, products, **kwargs) -> (sol, dh)`
+    :param candidate: a solver of the same signature, or `f(pairs, **kwargs) -> [(sol, dh), ...]` if `batch`
+    :param indices: the index of each pair reported in a divergence, e.g. from `sample_pairs`, default 0, 1, ...
+    :param batch: if the candidate solves a list of pairs at once, e.g. `find_lp_batch`
+    :param atol_dh: absolute tolerance of delta H
+    :param atol_sol: absolute tolerance of each x_i, None to only compare delta H
+    :param n_jobs: number of workers, solvers must be picklable when using processes
+    :param threads: use threads instead of processes
+    :param chunk_size: number of pairs sent to a worker at once
+    :return: None if all pairs agree, otherwise a dictionary of
+        `index`, `reason` (see `compare_results`, "error" if the candidate raised,
+        "reference_error" if the reference raised),
+        `reactant`, `n_products`, `reference` and `candidate` results
+    """
+    if reference_kwargs is None:
+        reference_kwargs = dict()
+    if candidate_kwargs is None:
+        candidate_kwargs = dict()
+    if indices is None:
+        indices = list(range(len(pairs)))
+    assert len(indices) == len(pairs)
+    args = (reference, reference_kwargs, candidate, candidate_kwargs, batch, atol_dh, atol_sol)
+    starts = range(0, len(pairs), chunk_size)
+    if n_jobs == 1:
+        for start in starts:
+            divergence = _diff_chunk(pairs[start:start + chunk_size], indices[start:start + chunk_size], *args)
+            if divergence is not None:
+                return divergence
+        return None
+    executor_class = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    with executor_class(max_workers=n_jobs) as executor:
+        futures = [
+            executor.submit(_diff_chunk, pairs[start:start + chunk_size], indices[start:start + chunk_size], *args)
+            for start in starts
+        ]
+        for future in futures:
+            divergence = future.result()
+            if divergence is not None:
+                # later chunks cannot have an earlier divergence
+                for f in futures:
+                    f.cancel()
+                return divergence
+    return None
+
+
+def format_divergence(divergence: Optional[dict]) -> str:
+    if divergence is None:
+        return "no divergence"
+    return "pair {} diverges by {}: reactant {} with {} products\n  reference: {}\n  candidate: {}".format(
+        divergence["index"], divergence["reason"], divergence["reactant"], divergence["n_products"],
+        divergence["reference"], divergence["candidate"],
+    )
@@ -0,0 +1,130 @@
+from typing import Tuple, Optional
+
+import numpy as np
+
+from whygreedy.algo import check_solution
+from whygreedy.schema import Compound, get_reactive_species
+
+"""
+degenerate pairs whose optimum is determined by stoichiometry,
+these can be solved in closed form without building a LP model or looping over first choices
+
+- empty: (LP only) no product, the greedy wrappers return (None, inf) for this and are left to do so
+- single_element: the reactant has only one element (other than the reactive species),
+  the best product is the one with the lowest enthalpy per unit of that element, for both greedy and LP
+- single_product: only one product that consumes the reactant exactly
+- two_products: (LP only) the optimum is at a vertex of the feasible region, there are only three of them
+"""
+
+PATHS = ("empty", "single_element", "single_product", "two_products", "general")
+
+
+def classify_pair(
+        reactant: Compound, products: list[Compound], exact: bool, for_oxide: bool = True,
+        reactive_species: tuple[str, ...] = None,
+) -> str:
+    """
+    classify a pair to one of `PATHS`, note `empty` and `two_products` can only be solved in closed form for LP
+
+    :param exact: if True, classify for `find_lp`, elements are those in the stoichiometric constraints,
+        otherwise classify for the greedy algorithms, elements are those used in the ranking parameter
+    :param for_oxide: for greedy only, if oxygen is excluded in ranking
+    :param reactive_species: for greedy only, elements excluded in ranking, overrides `for_oxide`
+    """
+    if len(products) == 0:
+        return "empty"
+    if exact:
+        elements = _constrained_elements(reactant, products)
+        if len(elements) == 1 and all(elements[0] in p.normalized_formula for p in products):
+            return "single_element"
+    else:
+        reactive_species = get_reactive_species(for_oxide, reactive_species)
+        elements = reactant.elements_exclude(reactive_species)
+        if len(elements) == 1 and all(p.elements_exclude(reactive_species) == elements for p in products):
+            return "single_element"
+    if len(products) == 1:
+        return "single_product"
+    if len(products) == 2:
+        return "two_products"
+    return "general"
+
+
+def find_closed_form(
+        reactant: Compound, products: list[Compound], exact: bool, for_oxide: bool = True,
+        reactive_species: tuple[str, ...] = None,
+) -> Tuple[str, Optional[Tuple[list[float], float]]]:
+    """
+    solve a degenerate pair in closed form
+
+    :param reactant: the reactant
+    :param products: the products
+    :param exact: if True, reproduce `find_lp`, otherwise reproduce the greedy wrappers
+        `find_greedy_first_choices` and `find_greedy_old_first_choices`
+    :param for_oxide: for greedy only, if oxygen is excluded in ranking
+    :param reactive_species: for greedy only, elements excluded in ranking, overrides `for_oxide`
+    :return: (path, (sol, dh)), (sol, dh) is None if the pair should go to the general solvers
+    """
+    path = classify_pair(reactant, products, exact=exact, for_oxide=for_oxide, reactive_species=reactive_species)
+    if path == "empty" and exact:
+        return path, ([], - reactant.formation_energy_per_atom)
+    if path == "empty":
+        return "general", None
+    if path == "single_element":
+        # for a single element, x_i = r / p_i, and the enthalpy x_i * E_i is the ranking parameter
+        if exact:
+            e = _constrained_elements(reactant, products)[0]
+        else:
+            e = reactant.elements_exclude(get_reactive_species(for_oxide, reactive_species))[0]
+        ratios = [reactant.normalized_formula[e] / p.normalized_formula[e] for p in products]
+        ibest = int(np.argmin([ratio * p.formation_energy_per_atom for ratio, p in zip(ratios, products)]))
+        sol = [0.0, ] * len(products)
+        sol[ibest] = ratios[ibest]
+        dh = ratios[ibest] * products[ibest].formation_energy_per_atom - reactant.formation_energy_per_atom
+        return path, (sol, dh)
+    if path == "single_product" or (path == "two_products" and exact):
+        result = _find_vertex(reactant, products)
+        if result is not None:
+            return path, result
+    return "general", None
+
+
+def _constrained_elements(reactant: Compound, products: list[Compound]) -> list[str]:
+    # same as the elements used in the constraints of `find_lp`
+    elements_in_products = set()
+    for product in products:
+        elements_in_products.update(product.elements)
+    return sorted(set(reactant.elements).intersection(elements_in_products))
+
+
+def _find_vertex(reactant: Compound, products: list[Compound]) -> Optional[Tuple[list[float], float]]:
+    """
+    enumerate the supports of a tiny LP and pick the feasible one of the lowest objective,
+    this is exact because the optimum of a LP is at a basic feasible solution,
+    a single product is accepted only if it consumes the reactant exactly
+    """
+    elements = _constrained_elements(reactant, products)
+    a = np.array([[p.normalized_formula.get(e, 0.0) for p in products] for e in elements])
+    b = np.array([reactant.normalized_formula[e] for e in elements])
+    # a product without any constrained element makes the LP unbounded, leave it to the general solvers
+    if len(elements) == 0 or np.any(np.all(a <= 0, axis=0)):
+        return None
+    if len(products) == 1:
+        supports = [[0]]
+    else:
+        supports = [[0], [1], [0, 1]]
+    best = None
+    for support in supports:
+        x_support = np.linalg.lstsq(a[:, support], b, rcond=None)[0]
+        if np.any(x_support < 0):
+            continue
+        sol = [0.0, ] * len(products)
+        for i, x_i in zip(support, x_support):
+            sol[i] = float(x_i)
+        if not check_solution(sol, products, reactant):
+            continue
+        objective = sum(x_i * p.formation_energy_per_atom for x_i, p in zip(sol, products))
+        if best is None or objective < best[1]:
+            best = (sol, objective)
+    if best is None:
+        return None
+    return best[0], best[1] - reactant.formation_energy_per_atom
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from itertools import combinations
+
+from whygreedy.schema import Compound, get_reactive_species
+
+"""
+a chemical system index maps a chemical system (frozenset of elements) to the compounds in it,
+candidate products of a reactant can then be found by looking up the subsets of its chemical system
+"""
+
+
+def chemsys_subsets(elements: list[str]) -> list[frozenset]:
+    """
+    all non-empty subsets of a chemical system, smaller subsets first
+    """
+    elements = sorted(set(elements))
+    subsets = []
+    for i in range(1, len(elements) + 1):
+        subsets += [frozenset(c) for c in combinations(elements, i)]
+    return subsets
+
+
+class ChemsysIndex:
+
+    def __init__(self, compounds: list[Compound]):
+        self.chemsys_to_compounds = OrderedDict()
+        for c in compounds:
+            try:
+                self.chemsys_to_compounds[frozenset(c.elements)].append(c)
+            except KeyError:
+                self.chemsys_to_compounds[frozenset(c.elements)] = [c, ]
+        # chemical systems are ordered by first appearance, same as the pair builders in `whygreedy.mp`
+        self.chemsys_rank = {chemsys: i for i, chemsys in enumerate(self.chemsys_to_compounds)}
+
+    def __len__(self):
+        return len(self.chemsys_to_compounds)
+
+    def get(self, chemsys: frozenset) -> list[Compound]:
+        return self.chemsys_to_compounds.get(chemsys, [])
+
+    def find_products(
+            self, elements: list[str], for_oxide: bool, exclude: Compound = None,
+            reactive_species: tuple[str, ...] = None,
+    ) -> list[Compound]:
+        """
+        find candidate products of a reactant consisting of `elements`
+
+        :param elements: elements of the reactant
+        :param for_oxide: if True, products are oxides whose non-oxygen elements are a subset of `elements`,
+            otherwise products are compounds whose elements are a subset of `elements`
+        :param exclude: a compound to be excluded from the products, usually the reactant itself
+        :param reactive_species: overrides `for_oxide`, products contain at least one of these elements,
+            and their other elements are a subset of `elements`
+        :return: a list of products, ordered by chemical system then by the order they were indexed
+        """
+        reactive_species = get_reactive_species(for_oxide, reactive_species)
+        found = set()
+        for subset in chemsys_subsets(elements):
+            if len(reactive_species) == 0:
+                candidates = [subset]
+            else:
+                candidates = [subset.union(s) for s in chemsys_subsets(reactive_species)]
+            found.update(chemsys for chemsys in candidates if chemsys in self.chemsys_rank)
+        products = []
+        for chemsys in sorted(found, key=self.chemsys_rank.get):
+            for c in self.chemsys_to_compounds[chemsys]:
+                if c is not exclude:
+                    products.append(c)
+        return products
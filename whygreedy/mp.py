@@ -4,14 +4,16 @@ from collections import OrderedDict
 import tqdm
 
 from whygreedy import json_load, Compound
+from whygreedy.index import ChemsysIndex
+from whygreedy.schema import REACTIVE_SPECIES
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 mpdata = os.path.join(this_dir, "../data/mp.json.gz")
 
 
-def load_mp() -> list[dict]:
+def load_mp(fn: str = mpdata) -> list[dict]:
     clean_data = []
-    data = json_load(mpdata)
+    data = json_load(fn)
     neclude = 0
     for compound in data:
         if None not in compound.values():
@@ -122,11 +124,64 @@ def load_mp_decomposition_pairs():
     return pairs
 
 
-def load_mp_oxidation_pairs():
+def load_mp_oxidation_pairs(criteria: float = 50):
     mp_data = load_mp()
-    compounds = find_stable_compounds(mp_data, 50)
+    compounds = find_stable_compounds(mp_data, criteria)
     print("stable compounds:", len(compounds))
     compounds = [mpdata_to_compound(c) for c in compounds]
     pairs = find_oxide_pairs_from_compounds(compounds)
     print("# of pairs loaded:", len(pairs))
     return pairs
+
+
+def find_environment_pairs_from_compounds(
+        compounds: list[Compound], reaction_types: list[str], index: ChemsysIndex = None,
+) -> dict[str, list[tuple[Compound, list[Compound]]]]:
+    """
+    pairs for several environments in one pass over `compounds` with one shared chemical system index
+
+    for a reaction type with reactive species S (see `REACTIVE_SPECIES`), the reactants are compounds free of S,
+    the products are compounds containing S whose other elements are a subset of the elements of the reactant,
+    a reactant with no product is skipped. For decomposition (S is empty), the products are all other compounds
+    in the subsets of the chemical system of the reactant.
+    The products are in the same order as `find_oxide_pairs_from_compounds` and `load_mp_decomposition_pairs`.
+
+    :param compounds: the compounds used as both reactants and products
+    :param reaction_types: keys of `REACTIVE_SPECIES`
+    :param index: a prebuilt index of `compounds`, built here if not given
+    :return: a dictionary of reaction type -> pairs
+    """
+    for reaction_type in reaction_types:
+        if reaction_type not in REACTIVE_SPECIES:
+            raise ValueError("reaction_type is: {}".format(reaction_type))
+    if index is None:
+        print("create chemsys index...")
+        index = ChemsysIndex(compounds)
+    print("# of chemical systems:", len(index))
+    pairs = {reaction_type: [] for reaction_type in reaction_types}
+    print("create pairs for: {}".format(reaction_types))
+    for c in tqdm.tqdm(compounds):
+        for reaction_type in reaction_types:
+            reactive_species = REACTIVE_SPECIES[reaction_type]
+            if any(e in reactive_species for e in c.elements):
+                continue
+            products = index.find_products(c.elements, for_oxide=False, exclude=c, reactive_species=reactive_species)
+            if len(products) == 0 and len(reactive_species) > 0:
+                continue
+            pairs[reaction_type].append((c, products))
+    for reaction_type in reaction_types:
+        print("# of {} pairs: {}".format(reaction_type, len(pairs[reaction_type])))
+    return pairs
+
+
+def load_mp_environment_pairs(reaction_types: list[str], criteria: float = 50):
+    """
+    pairs for several environments from materials project compounds with e_above_hull (meV) smaller than `criteria`,
+    all compounds are used if `criteria` is None
+    """
+    mp_data = load_mp()
+    if criteria is not None:
+        mp_data = find_stable_compounds(mp_data, criteria)
+        print("stable compounds:", len(mp_data))
+    compounds = [mpdata_to_compound(c) for c in mp_data]
+    return find_environment_pairs_from_compounds(compounds, reaction_types)
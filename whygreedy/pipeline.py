@@ -0,0 +1,123 @@
+import queue
+import threading
+from typing import Iterable, Iterator, Callable, TypeVar
+
+"""
+a streaming pipeline of threads connected by bounded queues, e.g.
+reading pairs -> solving pairs -> writing records,
+reading and writing overlap with solving, and only a bounded number of items is held by each stage
+"""
+
+T = TypeVar("T")
+
+# marks the end of a queue
+_END = object()
+
+
+class _Failure:
+    # an exception raised in a background thread, raised again in the consuming thread
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    """
+    group items to lists of `size`, the last one may be shorter
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def _iter_queue(q: queue.Queue) -> Iterator:
+    while True:
+        item = q.get()
+        if item is _END:
+            return
+        if isinstance(item, _Failure):
+            raise item.error
+        yield item
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    # put with a timeout so a stopped pipeline never blocks forever, return False if stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def prefetch(iterable: Iterable, maxsize: int) -> Iterator:
+    """
+    iterate `iterable` in a background thread, at most `maxsize` items are read ahead,
+    e.g. to unpickle pairs while the previous ones are being solved
+
+    an exception in the background thread is raised in the consuming thread
+    """
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not _put(q, item, stop):
+                    return
+        except BaseException as e:
+            _put(q, _Failure(e), stop)
+        else:
+            _put(q, _END, stop)
+
+    thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        yield from _iter_queue(q)
+    finally:
+        # the consumer is done or failed, let the producer exit
+        stop.set()
+        thread.join()
+
+
+def consume_in_background(consumer: Callable[[Iterator], T], iterable: Iterable, maxsize: int) -> T:
+    """
+    feed `iterable` to `consumer` running in a background thread through a queue of `maxsize`,
+    e.g. to pickle records while the next ones are being solved
+
+    :return: what `consumer` returns, an exception in either thread is raised
+    """
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    result = dict()
+
+    def consume():
+        try:
+            result["value"] = consumer(_iter_queue(q))
+        except BaseException as e:
+            result["error"] = e
+        finally:
+            # unblock the feeding thread if the consumer stopped early
+            stop.set()
+
+    thread = threading.Thread(target=consume, name="consume", daemon=True)
+    thread.start()
+    try:
+        for item in iterable:
+            if not _put(q, item, stop):
+                break
+    except BaseException as e:
+        _put(q, _Failure(e), stop)
+        thread.join()
+        raise
+    else:
+        _put(q, _END, stop)
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
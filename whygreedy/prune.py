@@ -0,0 +1,246 @@
+import threading
+from typing import Hashable
+
+import gurobipy as gp
+from gurobipy import GRB
+
+from whygreedy.index import chemsys_subsets
+from whygreedy.schema import Compound
+
+"""
+remove products that lie above the lower hull of their own chemical system before solving a LP
+
+a product P of chemical system S is dominated if a combination of other products whose elements are in S
+has the same composition and a lower formation energy per atom,
+as compositions are normalized, replacing x_P * P by x_P * (sum_j l_j * P_j) keeps the amount of every element
+and lowers the objective, so the LP optimum is never changed by removing P.
+This does not hold for the greedy algorithms, they follow the ranking parameter instead of the LP optimum.
+
+pairs draw their products from a shared set of compounds, e.g. all decomposition pairs of Fe-Mn-O share the products
+in Fe-O, so the hull is computed once per compound over all compounds seen in its chemical system (and subsystems):
+a compound on that hull is on the hull of any pair containing it, and a dominated compound is removed from a pair
+if the compounds dominating it (its certificate) are in the pair too.
+Otherwise, e.g. the reactant of a decomposition pair is left out of its products but dominates some of them,
+the compound is checked again against the products of that pair only.
+"""
+
+
+def compound_key(c: Compound) -> Hashable:
+    # the hull only depends on compositions and energies, this is stable across processes and pickles,
+    # the mpid (with the energy) is used if there is one as it is much cheaper than sorting the formula
+    if c.mpid is not None:
+        return c.mpid, c.formation_energy_per_atom
+    return tuple(sorted(c.normalized_formula.items())), c.formation_energy_per_atom
+
+
+def expand_solution(sol: list[float], kept: list[int], n_products: int) -> list[float]:
+    """
+    map a solution over the kept products back to the original product indexing
+    """
+    expanded = [0.0, ] * n_products
+    for i, x_i in zip(kept, sol):
+        expanded[i] = x_i
+    return expanded
+
+
+class HullPruner:
+
+    def __init__(self, tol: float = 1e-6, max_vars: int = 1000):
+        """
+        :param tol: a product is removed only if it is above the hull by more than this (eV/atom)
+        :param max_vars: max number of variables in one LP, LPs of a pair are solved together up to this size
+        """
+        self.tol = tol
+        self.max_vars = max_vars
+        # key -> chemical system, and chemical system -> {key: compound} of all compounds seen
+        self.chemsys_of = dict()
+        self.members = dict()
+        # chemical system -> chemical systems containing it, of all compounds seen
+        self.supersystems = dict()
+        # key -> None if on the hull of the compounds seen, otherwise keys of the compounds dominating it
+        self.certificates = dict()
+        # chemical system -> keys of its compounds on the hull, dropped when a compound is added to a subsystem
+        self.on_hull = dict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.n_rechecks = 0
+        self.n_pairs = 0
+        self.n_products_before = 0
+        self.n_products_after = 0
+        self._lock = threading.Lock()
+        self._env = None
+
+    def __getstate__(self):
+        # a lock or a gurobi environment cannot be pickled, e.g. when a calculator is sent to a process pool
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_env"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def prune(self, reactant: Compound, products: list[Compound]) -> list[int]:
+        """
+        :return: sorted indices of the products that are kept
+        """
+        with self._lock:
+            keys = [compound_key(c) for c in products]
+            for key, c in zip(keys, products):
+                if key not in self.chemsys_of:
+                    self.add_compound(key, c)
+            pair_keys = dict.fromkeys(keys)
+
+            # compounds not solved yet are solved against all compounds seen in their chemical system
+            n_new = sum(key not in self.certificates for key in keys)
+            self.cache_misses += n_new
+            self.cache_hits += len(products) - n_new
+            new_keys = [key for key in pair_keys if key not in self.certificates]
+            for key, certificate in zip(new_keys, self.find_certificates(
+                    [(self.members[self.chemsys_of[key]][key], self.pool(key)) for key in new_keys])):
+                self.certificates[key] = certificate
+                if certificate is None:
+                    self.on_hull[self.chemsys_of[key]].add(key)
+
+            kept = []
+            recheck = []
+            for i, key in enumerate(keys):
+                certificate = self.certificates[key]
+                if certificate is None:
+                    kept.append(i)
+                elif not all(k in pair_keys for k in certificate):
+                    recheck.append(i)
+            # a compound dominated by compounds that are not in this pair is checked against the products of
+            # this pair, those removed above are left out, they are beaten by their certificates
+            self.n_rechecks += len(recheck)
+            pools = []
+            for i in recheck:
+                chemsys = self.chemsys_of[keys[i]]
+                pools.append([products[j] for j in kept + recheck
+                              if keys[j] != keys[i] and self.chemsys_of[keys[j]] <= chemsys])
+            for i, certificate in zip(recheck, self.find_certificates(
+                    [(products[i], pool) for i, pool in zip(recheck, pools)])):
+                if certificate is None:
+                    kept.append(i)
+
+            kept = sorted(kept)
+            self.n_pairs += 1
+            self.n_products_before += len(products)
+            self.n_products_after += len(kept)
+            return kept
+
+    def add_compound(self, key: Hashable, c: Compound):
+        chemsys = frozenset(c.normalized_formula)
+        self.chemsys_of[key] = chemsys
+        if chemsys not in self.members:
+            self.members[chemsys] = dict()
+            self.on_hull[chemsys] = set()
+            for sub in chemsys_subsets(chemsys):
+                self.supersystems.setdefault(sub, []).append(chemsys)
+        self.members[chemsys][key] = c
+        # a new compound may dominate compounds on the hull of chemical systems containing it,
+        # dominated compounds stay dominated
+        for sup in self.supersystems[chemsys]:
+            for k in self.on_hull[sup]:
+                del self.certificates[k]
+            self.on_hull[sup].clear()
+
+    def pool(self, key: Hashable) -> list[Compound]:
+        """
+        compounds seen in the chemical system of `key` and its subsystems, except `key` and those known to be
+        dominated, a combination using a dominated compound is beaten by replacing it with its certificate
+        """
+        pool = []
+        for sub in chemsys_subsets(self.chemsys_of[key]):
+            pool += [c for k, c in self.members.get(sub, dict()).items()
+                     if k != key and self.certificates.get(k, None) is None]
+        return pool
+
+    def find_certificates(self, problems: list[tuple[Compound, list[Compound]]]) -> list[tuple or None]:
+        """
+        :param problems: a list of (target, others), others are compounds whose elements are in those of target
+        :return: for each problem, None if target is not dominated by a combination of others,
+            otherwise keys of the others in the lowest combination
+        """
+        if len(problems) == 0:
+            return []
+        if self._env is None:
+            self._env = gp.Env(empty=True)
+            self._env.setParam('OutputFlag', 0)
+            self._env.setParam('LogToConsole', 0)
+            self._env.setParam('FeasibilityTol', 1e-9)
+            self._env.setParam('OptimalityTol', 1e-9)
+            self._env.start()
+        certificates = []
+        batch = []
+        n_vars = 0
+        for target, others in problems:
+            if len(batch) > 0 and n_vars + len(others) + 1 > self.max_vars:
+                certificates += _lowest_combinations(self._env, batch, self.tol)
+                batch = []
+                n_vars = 0
+            batch.append((target, others))
+            n_vars += len(others) + 1
+        certificates += _lowest_combinations(self._env, batch, self.tol)
+        return certificates
+
+    def report(self) -> dict:
+        """
+        how much the problem size shrank
+        """
+        n_before = self.n_products_before
+        return dict(
+            n_pairs=self.n_pairs,
+            n_products_before=n_before,
+            n_products_after=self.n_products_after,
+            fraction_removed=1 - self.n_products_after / n_before if n_before > 0 else 0.0,
+            cache_hits=self.cache_hits,
+            cache_misses=self.cache_misses,
+            n_rechecks=self.n_rechecks,
+        )
+
+
+def _lowest_combinations(env: gp.Env, problems: list[tuple[Compound, list[Compound]]], tol: float) -> list:
+    # the lowest combination of others with the composition of target for each (target, others),
+    # solved as one block-diagonal LP, target is in its own block so every block is feasible,
+    # see `HullPruner.find_certificates`
+    certificates = [None, ] * len(problems)
+    # a combination is never lower than its lowest compound
+    todo = [i for i, (target, others) in enumerate(problems)
+            if any(c.formation_energy_per_atom < target.formation_energy_per_atom - tol for c in others)]
+    if len(todo) == 0:
+        return certificates
+    with gp.Model(env=env) as m:
+        # variables are non-negative by default
+        x_all = list(m.addVars(sum(len(problems[i][1]) + 1 for i in todo)).values())
+        objective = gp.LinExpr()
+        ivar = 0
+        for i in todo:
+            target, others = problems[i]
+            compounds = [target] + others
+            x = x_all[ivar:ivar + len(compounds)]
+            ivar += len(compounds)
+            # the elements of others are in those of target
+            terms = {e: ([], []) for e in target.normalized_formula}
+            for x_j, c in zip(x, compounds):
+                for e, amount in c.normalized_formula.items():
+                    terms[e][0].append(amount)
+                    terms[e][1].append(x_j)
+            for e, (coeffs, x_e) in terms.items():
+                m.addLConstr(gp.LinExpr(coeffs, x_e), GRB.EQUAL, target.normalized_formula[e])
+            objective.addTerms([c.formation_energy_per_atom for c in compounds], x)
+        m.setObjective(objective, GRB.MINIMIZE)
+        m.optimize()
+        assert m.Status == GRB.OPTIMAL
+        values = m.getAttr("X", x_all)
+    ivalue = 0
+    for i in todo:
+        target, others = problems[i]
+        sol = values[ivalue:ivalue + len(others) + 1]
+        ivalue += len(others) + 1
+        e_min = sol[0] * target.formation_energy_per_atom
+        e_min += sum(x_j * c.formation_energy_per_atom for x_j, c in zip(sol[1:], others))
+        if e_min < target.formation_energy_per_atom - tol:
+            certificates[i] = tuple(compound_key(c) for x_j, c in zip(sol[1:], others) if x_j > 1e-9)
+    return certificates
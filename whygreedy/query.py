@@ -0,0 +1,156 @@
+import json
+import re
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Union
+from urllib.parse import urlparse, parse_qs
+
+from whygreedy.calculator import get_cal_function
+from whygreedy.index import ChemsysIndex
+from whygreedy.schema import Compound, normalize_stoi, REACTIVE_SPECIES
+
+"""
+in-process query of the reaction enthalpy for an arbitrary compound,
+candidate products are looked up from a prebuilt `ChemsysIndex`, and results are kept in a LRU cache
+"""
+
+_formula_pattern = re.compile(r"([A-Z][a-z]?)(\d*\.?\d*)")
+
+
+def parse_formula(formula: Union[str, dict[str, float]]) -> dict[str, float]:
+    """
+    parse a formula like `Fe2O3` or `{"Fe": 2, "O": 3}` to a normalized formula dictionary
+    """
+    if isinstance(formula, dict):
+        formula_dictionary = {k: float(v) for k, v in formula.items()}
+    else:
+        formula = formula.replace(" ", "")
+        if "".join(m.group(0) for m in _formula_pattern.finditer(formula)) != formula or len(formula) == 0:
+            raise ValueError("cannot parse formula: {}".format(formula))
+        formula_dictionary = dict()
+        for element, amount in _formula_pattern.findall(formula):
+            formula_dictionary[element] = formula_dictionary.get(element, 0) + float(amount or 1)
+    formula_dictionary = {k: v for k, v in formula_dictionary.items() if v > 0}
+    if len(formula_dictionary) == 0:
+        raise ValueError("empty formula: {}".format(formula))
+    return normalize_stoi(formula_dictionary)
+
+
+class StabilityQuery:
+
+    def __init__(self, index: ChemsysIndex, maxsize: int = 4096, ndigits: int = 10):
+        """
+        :param index: chemical system index of the compounds used as candidate products
+        :param maxsize: max number of queries kept in the LRU cache
+        :param ndigits: compositions and energies are rounded to this many digits to form cache keys
+        """
+        self.index = index
+        self.ndigits = ndigits
+        self._query_cached = lru_cache(maxsize=maxsize)(self._query)
+
+    @classmethod
+    def from_mp(cls, criteria: float = 50, **kwargs):
+        """
+        build the index from materials project compounds with e_above_hull (meV) smaller than `criteria`
+        """
+        from whygreedy.mp import load_mp, find_stable_compounds, mpdata_to_compound
+        compounds = [mpdata_to_compound(c) for c in find_stable_compounds(load_mp(), criteria)]
+        return cls(ChemsysIndex(compounds), **kwargs)
+
+    def query(
+            self, formula: Union[str, dict[str, float]], formation_energy_per_atom: float,
+            method: str = "lp", reaction_type: str = "oxidation", firstk: int = None,
+    ) -> dict:
+        """
+        minimize the reaction enthalpy of a compound
+
+        :param formula: formula of the reactant, e.g. `Fe2O3` or `{"Fe": 2, "O": 3}`
+        :param formation_energy_per_atom: formation energy of the reactant in eV/atom
+        :param method: lazy, diligent, lp
+        :param reaction_type: one of `REACTIVE_SPECIES`, e.g. oxidation, decomposition
+        :param firstk: how many different first choices to try in a greedy algorithm, default all choices
+        :return: a record of `sol`, `dh`, and the `products` used
+        """
+        normalized_formula = parse_formula(formula)
+        key_formula = tuple(sorted((k, round(v, self.ndigits)) for k, v in normalized_formula.items()))
+        record = self._query_cached(
+            key_formula, round(formation_energy_per_atom, self.ndigits), method, reaction_type, firstk
+        )
+        # do not hand out the cached lists
+        return {k: list(v) if isinstance(v, list) else v for k, v in record.items()}
+
+    def _query(self, key_formula: tuple, formation_energy_per_atom: float, method: str, reaction_type: str,
+               firstk: int) -> dict:
+        cal_function, cal_function_kwargs = get_cal_function(method, reaction_type, firstk)
+        reactant = Compound(dict(key_formula), formation_energy_per_atom)
+        reactive_species = REACTIVE_SPECIES[reaction_type]
+        if len(reactant.elements_exclude(reactive_species)) != len(reactant.elements):
+            raise ValueError("the reactant of {} cannot have {}: {}".format(reaction_type, reactive_species, reactant))
+        products = self.index.find_products(reactant.elements, for_oxide=False, reactive_species=reactive_species)
+        if len(products) == 0:
+            # same as `find_lp`, the greedy wrappers would return (None, inf)
+            sol, dh = [], - reactant.formation_energy_per_atom
+        else:
+            sol, dh = cal_function(reactant=reactant, products=products, **cal_function_kwargs)
+        return dict(
+            sol=list(sol), dh=dh,
+            reactant=dict(key_formula),
+            products=[prod.mpid for prod in products]
+        )
+
+    def cache_info(self):
+        return self._query_cached.cache_info()
+
+    def cache_clear(self):
+        self._query_cached.cache_clear()
+
+
+def serve(query: StabilityQuery, host: str = "127.0.0.1", port: int = 8000):
+    """
+    a local http front end of `StabilityQuery`, e.g.
+    `GET /query?formula=Fe2Si&energy=-0.3&method=lp&reaction_type=oxidation`
+    `GET /cache_info`
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send(self, code: int, d: dict):
+            body = json.dumps(d).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/cache_info":
+                self._send(200, query.cache_info()._asdict())
+                return
+            if url.path != "/query":
+                self._send(404, {"error": "unknown path: {}".format(url.path)})
+                return
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            try:
+                record = query.query(
+                    formula=params["formula"],
+                    formation_energy_per_atom=float(params["energy"]),
+                    method=params.get("method", "lp"),
+                    reaction_type=params.get("reaction_type", "oxidation"),
+                    firstk=int(params["firstk"]) if "firstk" in params else None,
+                )
+            except (KeyError, ValueError) as e:
+                self._send(400, {"error": repr(e)})
+                return
+            except Exception as e:
+                # a solver failed, the client still gets a json error instead of a dropped connection
+                self._send(500, {"error": repr(e)})
+                return
+            self._send(200, record)
+
+        def log_message(self, format, *args):
+            pass
+
+    with ThreadingHTTPServer((host, port), Handler) as httpd:
+        print("serving on http://{}:{}".format(host, port))
+        httpd.serve_forever()
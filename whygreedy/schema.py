@@ -15,6 +15,26 @@ def is_close_to_zero(f: float, eps=1e-5):
     return abs(f) < eps
 
 
+# elements supplied by the environment in each type of reaction,
+# they are excluded from the ranking parameter and the reactant should not contain them
+REACTIVE_SPECIES = {
+    "oxidation": ("O",),
+    "nitridation": ("N",),
+    "hydration": ("H", "O"),
+    "carbonation": ("C", "O"),
+    "decomposition": (),
+}
+
+
+def get_reactive_species(for_oxide: bool, reactive_species: tuple[str, ...] = None) -> tuple[str, ...]:
+    """
+    `reactive_species` overrides `for_oxide`, otherwise oxygen is reactive for oxidation and nothing for decomposition
+    """
+    if reactive_species is not None:
+        return tuple(reactive_species)
+    return REACTIVE_SPECIES["oxidation"] if for_oxide else REACTIVE_SPECIES["decomposition"]
+
+
 class Compound(MSONable):
 
     def __init__(
@@ -39,6 +59,9 @@ class Compound(MSONable):
     def elements_exclude_oxygen(self):
         return [e for e in self.elements if e != "O"]
 
+    def elements_exclude(self, species: tuple[str, ...]):
+        return [e for e in self.elements if e not in species]
+
     @property
     def is_oxide(self):
         return "O" in self.elements
@@ -76,22 +99,22 @@ def is_competing_pair(cp: Compound, original: Compound):
     return set(original.elements).issuperset(set(cp.elements))
 
 
-def compound_subtract(oxide: Compound, original: Compound, for_oxide: bool) -> Tuple[float, Compound]:
+def is_reaction_pair(product: Compound, original: Compound, reactive_species: tuple[str, ...]):
+    return set(original.elements).issuperset(set(product.elements_exclude(reactive_species)))
+
+
+def compound_subtract(
+        oxide: Compound, original: Compound, for_oxide: bool, reactive_species: tuple[str, ...] = None
+) -> Tuple[float, Compound]:
     # note this will update the original
-    if for_oxide:
-        assert is_oxidation_pair(oxide, original)
-        ratios = [original.normalized_formula[x] / oxide.normalized_formula[x] for x in oxide.elements_exclude_oxygen]
-        ratio = min(ratios)
-        for e in oxide.elements_exclude_oxygen:
-            original.normalized_formula[e] -= ratio * oxide.normalized_formula[e]
-        return ratio, original
-    else:
-        assert is_competing_pair(oxide, original)
-        ratios = [original.normalized_formula[x] / oxide.normalized_formula[x] for x in oxide.elements]
-        ratio = min(ratios)
-        for e in oxide.elements:
-            original.normalized_formula[e] -= ratio * oxide.normalized_formula[e]
-        return ratio, original
+    reactive_species = get_reactive_species(for_oxide, reactive_species)
+    assert is_reaction_pair(oxide, original, reactive_species)
+    elements = oxide.elements_exclude(reactive_species)
+    ratios = [original.normalized_formula[x] / oxide.normalized_formula[x] for x in elements]
+    ratio = min(ratios)
+    for e in elements:
+        original.normalized_formula[e] -= ratio * oxide.normalized_formula[e]
+    return ratio, original
 
 
 def gen_random_data(elements: list[str], num_oxi_per_chemical_system: int, seed: int) -> Tuple[
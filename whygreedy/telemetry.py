@@ -0,0 +1,231 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from typing import Union
+
+from whygreedy.utils import file_type
+
+"""
+live metrics of a long calculation, written to a local file that a sidecar can scrape
+- a `.prom` file is overwritten with the latest snapshot in Prometheus text format
+- any other file is appended with one JSON line per snapshot
+snapshots are written when pairs finish and by a heartbeat, pairs in flight are reported per worker,
+so a stalled worker shows up even if nothing finishes
+"""
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+def get_peak_rss() -> Union[int, None]:
+    """
+    peak resident set size of the current process in bytes, None if not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Telemetry:
+
+    def __init__(self, fn: file_type, method: str, total: Union[int, None], total_cost: Union[float, None],
+                 interval: float = 5.0, events=None):
+        """
+        :param fn: output file, Prometheus text if it ends with `.prom`, otherwise JSON lines
+        :param method: label of the calculation
+        :param total: number of pairs to be calculated, None if unknown
+        :param total_cost: estimated cost of all pairs, used to weight the ETA, None if unknown (no ETA)
+        :param interval: min seconds between two snapshots, also the period of the heartbeat
+        :param events: a queue of (worker, wall time) put by workers in other processes when they start a pair,
+            workers in this process call `start` instead
+        """
+        self.fn = fn
+        self.method = method
+        self.total = total
+        self.total_cost = total_cost
+        self.interval = interval
+        self.events = events
+
+        self.ts_start = time.perf_counter()
+        self.ts_last_write = None
+        self.done = 0
+        self.done_at_last_write = 0
+        self.cost_done = 0.0
+        self.queue_depth = 0
+        self.worker_busy = dict()
+        self.worker_peak_rss = dict()
+        # wall times at which the pairs in flight were started, by worker
+        self.worker_running = dict()
+        # pairs finished before their start event arrived, by worker
+        self.worker_early_finished = dict()
+        self.worker_last_finished = dict()
+
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def start_heartbeat(self):
+        """
+        write a snapshot every `interval` seconds from a daemon thread,
+        so the file keeps changing while workers are stuck on long pairs
+        """
+        def beat():
+            while not self._stop.wait(max(self.interval, 0.1)):
+                self.write(force=True)
+
+        self._heartbeat = threading.Thread(target=beat, name="telemetry", daemon=True)
+        self._heartbeat.start()
+
+    def close(self):
+        """
+        stop the heartbeat and write the last snapshot
+        """
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        self.write(force=True)
+
+    def start(self, worker: str, n: int = 1, ts: float = None):
+        """
+        record `n` pairs started by a worker
+
+        :param ts: wall time (`time.time()`) at which the pairs were started, default now
+        """
+        ts = time.time() if ts is None else ts
+        with self._lock:
+            for _ in range(n):
+                if self.worker_early_finished.get(worker, 0) > 0:
+                    # its finish is already counted
+                    self.worker_early_finished[worker] -= 1
+                else:
+                    self.worker_running.setdefault(worker, []).append(ts)
+
+    def drain_events(self):
+        # start events from other processes, they may arrive after the pairs are finished
+        if self.events is None:
+            return
+        while True:
+            try:
+                worker, ts = self.events.get_nowait()
+            except queue.Empty:
+                return
+            self.start(worker, ts=ts)
+
+    def update(self, worker: str, busy: float, cost: float, n: int = 1, queue_depth: int = None,
+               peak_rss: int = None):
+        """
+        record `n` finished pairs
+
+        :param worker: id of the worker that calculated the pairs
+        :param busy: seconds the worker spent on the pairs
+        :param cost: estimated cost of the pairs
+        :param n: number of pairs
+        :param queue_depth: number of pairs submitted but not yet finished
+        :param peak_rss: peak rss of the worker in bytes
+        """
+        with self._lock:
+            self.drain_events()
+            self.done += n
+            self.cost_done += cost
+            self.worker_busy[worker] = self.worker_busy.get(worker, 0.0) + busy
+            running = self.worker_running.get(worker, [])
+            for _ in range(n):
+                if len(running) > 0:
+                    running.pop(0)
+                else:
+                    self.worker_early_finished[worker] = self.worker_early_finished.get(worker, 0) + 1
+            self.worker_last_finished[worker] = time.perf_counter()
+            if peak_rss is not None:
+                self.worker_peak_rss[worker] = max(peak_rss, self.worker_peak_rss.get(worker, 0))
+            if queue_depth is not None:
+                self.queue_depth = queue_depth
+        self.write()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self.drain_events()
+            now = time.perf_counter()
+            wall_now = time.time()
+            elapsed = now - self.ts_start
+            if self.ts_last_write is None:
+                recent_rate = self.done / elapsed if elapsed > 0 else 0.0
+            else:
+                recent_rate = (self.done - self.done_at_last_write) / max(now - self.ts_last_write, 1e-9)
+            if self.cost_done > 0 and self.total_cost is not None:
+                eta = elapsed / self.cost_done * max(self.total_cost - self.cost_done, 0.0)
+            else:
+                eta = None
+            peak_rss = [v for v in [get_peak_rss(), *self.worker_peak_rss.values()] if v is not None]
+            workers = sorted(set(self.worker_busy).union(self.worker_running), key=str)
+            # seconds spent on the pairs in flight, counted as busy
+            running_seconds = {
+                w: sum(max(wall_now - ts, 0.0) for ts in self.worker_running.get(w, [])) for w in workers
+            }
+            return dict(
+                timestamp=time.time(),
+                method=self.method,
+                pairs_done=self.done,
+                pairs_total=self.total,
+                pairs_in_flight=sum(len(v) for v in self.worker_running.values()),
+                pairs_per_second=self.done / elapsed if elapsed > 0 else 0.0,
+                pairs_per_second_recent=recent_rate,
+                queue_depth=self.queue_depth,
+                eta_seconds=eta,
+                elapsed_seconds=elapsed,
+                worker_utilization={
+                    str(w): (self.worker_busy.get(w, 0.0) + running_seconds[w]) / elapsed if elapsed > 0 else 0.0
+                    for w in workers
+                },
+                worker_in_flight={str(w): len(self.worker_running.get(w, [])) for w in workers},
+                # the longest running pair of each worker, large values point to stalled workers
+                worker_running_seconds={
+                    str(w): max([wall_now - ts for ts in self.worker_running.get(w, [])], default=0.0)
+                    for w in workers
+                },
+                worker_seconds_since_finished={
+                    str(w): now - self.worker_last_finished.get(w, self.ts_start) for w in workers
+                },
+                peak_rss_bytes=max(peak_rss) if len(peak_rss) > 0 else None,
+            )
+
+    def write(self, force: bool = False):
+        with self._lock:
+            now = time.perf_counter()
+            if not force and self.ts_last_write is not None and now - self.ts_last_write < self.interval:
+                return
+            snapshot = self.snapshot()
+            if str(self.fn).endswith(".prom"):
+                tmp = "{}.tmp".format(self.fn)
+                with open(tmp, "w") as f:
+                    f.write(to_prometheus(snapshot))
+                os.replace(tmp, self.fn)
+            else:
+                with open(self.fn, "a") as f:
+                    f.write(json.dumps(snapshot) + "\n")
+            self.ts_last_write = now
+            self.done_at_last_write = self.done
+
+
+def to_prometheus(snapshot: dict) -> str:
+    method = snapshot["method"]
+    lines = []
+    for key in [
+        "pairs_done", "pairs_total", "pairs_in_flight", "pairs_per_second", "pairs_per_second_recent", "queue_depth", "eta_seconds",
+        "elapsed_seconds", "peak_rss_bytes",
+    ]:
+        if snapshot[key] is None:
+            continue
+        lines.append("# TYPE whygreedy_{} gauge".format(key))
+        lines.append('whygreedy_{}{{method="{}"}} {}'.format(key, method, snapshot[key]))
+    for key in ["worker_utilization", "worker_in_flight", "worker_running_seconds", "worker_seconds_since_finished"]:
+        lines.append("# TYPE whygreedy_{} gauge".format(key))
+        for worker, value in snapshot[key].items():
+            lines.append('whygreedy_{}{{method="{}",worker="{}"}} {}'.format(key, method, worker, value))
+    return "\n".join(lines) + "\n"
@@ -1,53 +1,251 @@
 import gzip
+import io
 import json
 import os
 import pickle
+import struct
 import time
 from pathlib import Path
-from typing import Union
+from typing import Union, Iterable, Iterator, BinaryIO
 
 import numpy as np
 from monty.json import MontyDecoder, MontyEncoder
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
 file_type = Union[Path, str]
 
+# magic bytes at the start of a compressed file, the codec of a file is detected from these when reading
+MAGIC = {
+    "gzip": b"\x1f\x8b",
+    "zstd": b"\x28\xb5\x2f\xfd",
+    "lz4": b"\x04\x22\x4d\x18",
+}
+CODECS = (None, "gzip", "zstd", "lz4")
 
-def json_dump(o, fn: file_type, compress=True) -> None:
-    if compress:
-        with gzip.open(fn, 'wt', encoding='UTF-8') as zipfile:
-            json.dump(o, zipfile, cls=MontyEncoder)
-    else:
-        with open(fn, "w") as f:
-            json.dump(o, f, cls=MontyEncoder)
+# start of a pickled object followed by its out-of-band buffers,
+# a pickle of protocol >= 2 starts with b"\x80" so the two are never confused
+OOB_MAGIC = b"WGOOB5\n"
+
+
+def detect_codec(fn: file_type) -> Union[str, None]:
+    """
+    :return: the codec of a file from its magic bytes, None if not compressed
+    """
+    with open(fn, "rb") as f:
+        head = f.read(4)
+    for codec, magic in MAGIC.items():
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+def open_compressed(fn: file_type, mode: str = "rb", codec: str = None, level: int = None, threads: int = 0) -> BinaryIO:
+    """
+    open a file for binary reading or writing through a codec
+
+    :param mode: "rb" or "wb"
+    :param codec: one of `CODECS` for writing, None for no compression,
+        ignored when reading as the codec is detected from the magic bytes
+    :param level: compression level, default to the default of the codec (9 for gzip, same as `gzip.open`)
+    :param threads: zstd only, number of compression threads, -1 for all cores, 0 to compress in the calling thread
+    """
+    if mode not in ("rb", "wb"):
+        raise ValueError("mode is: {}".format(mode))
+    if mode == "rb":
+        codec = detect_codec(fn)
+    if codec not in CODECS:
+        raise ValueError("codec is: {}".format(codec))
+    if codec is None:
+        return open(fn, mode)
+    if codec == "gzip":
+        return gzip.open(fn, mode, compresslevel=9 if level is None else level)
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError("codec zstd requires `zstandard`")
+        if mode == "rb":
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(fn, "rb"), closefd=True))
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level, threads=threads)
+        return compressor.stream_writer(open(fn, "wb"), closefd=True)
+    if lz4 is None:
+        raise ImportError("codec lz4 requires `lz4`")
+    return lz4.frame.open(fn, mode, compression_level=0 if level is None else level)
+
+
+def json_dump(o, fn: file_type, compress=True, codec: str = "gzip", level: int = None, threads: int = 0) -> None:
+    """
+    :param compress: if False, write plain json and ignore `codec`
+    :param codec: one of `CODECS`, see `open_compressed` for `level` and `threads`
+    """
+    if not compress:
+        codec = None
+    with io.TextIOWrapper(open_compressed(fn, "wb", codec, level, threads), encoding='UTF-8') as f:
+        json.dump(o, f, cls=MontyEncoder)
 
 
 def json_load(fn: file_type) -> dict:
-    try:
-        with gzip.open(fn, 'rt', encoding='UTF-8') as zipfile:
-            d = json.load(zipfile, cls=MontyDecoder)
-    except:
-        with open(fn, "r") as f:
-            d = json.load(f, cls=MontyDecoder)
+    """
+    load a json file, plain or compressed by any of `CODECS`
+    """
+    with io.TextIOWrapper(open_compressed(fn, "rb"), encoding='UTF-8') as f:
+        d = json.load(f, cls=MontyDecoder)
     return d
 
 
-def pkl_dump(o, fn: file_type) -> None:
+def pkl_dump(o, fn: file_type, codec: str = None, protocol: int = None, out_of_band: bool = False,
+             level: int = None, threads: int = 0) -> None:
+    """
+    :param codec: one of `CODECS`, see `open_compressed` for `level` and `threads`
+    :param protocol: pickle protocol, default `pickle.DEFAULT_PROTOCOL`
+    :param out_of_band: use protocol 5 and write buffers (e.g. of numpy arrays) outside the pickle stream,
+        so they are neither copied when dumping nor when loading
+    """
     ts1 = time.perf_counter()
-    with open(fn, "wb") as f:
-        pickle.dump(o, f)
+    with open_compressed(fn, "wb", codec, level, threads) as f:
+        _pickle_dump(o, f, protocol, out_of_band)
     ts2 = time.perf_counter()
     print("dumped {} in: {:.4f} s".format(os.path.basename(fn), ts2 - ts1))
 
 
 def pkl_load(fn: file_type):
+    """
+    load a pkl file, if the file was written by `pkl_dump_chunks`, the chunks are concatenated
+    """
     ts1 = time.perf_counter()
-    with open(fn, "rb") as f:
-        d = pickle.load(f)
+    chunks = list(pkl_load_chunks(fn))
+    if len(chunks) == 1:
+        d = chunks[0]
+    else:
+        d = [item for chunk in chunks for item in chunk]
     ts2 = time.perf_counter()
     print("loaded {} in: {:.4f} s".format(os.path.basename(fn), ts2 - ts1))
     return d
 
 
+def pkl_dump_chunks(chunks: Iterable[list], fn: file_type, codec: str = None, protocol: int = None,
+                    out_of_band: bool = False, level: int = None, threads: int = 0) -> int:
+    """
+    stream lists to a pkl file one chunk at a time, so the whole list is never in memory,
+    see `pkl_dump` for the other parameters
+
+    :return: total number of items dumped
+    """
+    ts1 = time.perf_counter()
+    n = 0
+    with open_compressed(fn, "wb", codec, level, threads) as f:
+        for chunk in chunks:
+            _pickle_dump(chunk, f, protocol, out_of_band)
+            n += len(chunk)
+    ts2 = time.perf_counter()
+    print("dumped {} items to {} in: {:.4f} s".format(n, os.path.basename(fn), ts2 - ts1))
+    return n
+
+
+def pairs_meta_path(fn: file_type) -> str:
+    return "{}.meta.json".format(fn)
+
+
+def pkl_dump_pairs(chunks: Iterable[list], fn: file_type, **kwargs) -> int:
+    """
+    `pkl_dump_chunks` for lists of pairs, and a small json sidecar next to `fn` (see `pairs_meta_path`)
+    with the number of pairs and the number of pairs by number of products,
+    so the work in a pairs file is known without reading it, see `load_pairs_meta`
+
+    :param kwargs: passed to `pkl_dump_chunks`
+    :return: total number of pairs dumped
+    """
+    n_products = dict()
+
+    def count(chunks):
+        for chunk in chunks:
+            for _, products in chunk:
+                n_products[len(products)] = n_products.get(len(products), 0) + 1
+            yield chunk
+
+    n = pkl_dump_chunks(count(chunks), fn, **kwargs)
+    # the size of the pairs file tells if the sidecar belongs to it
+    meta = dict(n_pairs=n, n_products=n_products, size=os.path.getsize(fn))
+    tmp = "{}.tmp".format(pairs_meta_path(fn))
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, pairs_meta_path(fn))
+    return n
+
+
+def load_pairs_meta(fn: file_type) -> Union[dict, None]:
+    """
+    :return: the sidecar written by `pkl_dump_pairs` with `n_products` as {number of products: number of pairs},
+        None if there is none or it was written for another file
+    """
+    meta_fn = pairs_meta_path(fn)
+    if not file_exists(meta_fn):
+        return None
+    with open(meta_fn, "r") as f:
+        meta = json.load(f)
+    if meta.get("size") != os.path.getsize(fn):
+        return None
+    meta["n_products"] = {int(k): v for k, v in meta["n_products"].items()}
+    return meta
+
+
+def pkl_load_chunks(fn: file_type) -> Iterator:
+    """
+    yield the objects pickled one after another in a pkl file,
+    a file written by `pkl_dump` contains only one object
+    """
+    with open_compressed(fn, "rb") as f:
+        while len(f.peek(1)) > 0:
+            yield _pickle_load(f)
+
+
+def _pickle_dump(o, f: BinaryIO, protocol: int, out_of_band: bool):
+    if not out_of_band:
+        pickle.dump(o, f, protocol=protocol)
+        return
+    buffers = []
+    data = pickle.dumps(o, protocol=5, buffer_callback=buffers.append)
+    # buffers go first, so they are ready when the pickle stream is loaded
+    f.write(OOB_MAGIC)
+    f.write(struct.pack("<Q", len(buffers)))
+    for buffer in buffers:
+        raw = buffer.raw()
+        f.write(struct.pack("<Q", raw.nbytes))
+        f.write(raw)
+    f.write(data)
+
+
+def _pickle_load(f: BinaryIO):
+    if f.peek(1)[:1] != OOB_MAGIC[:1]:
+        return pickle.load(f)
+    if f.read(len(OOB_MAGIC)) != OOB_MAGIC:
+        raise pickle.UnpicklingError("invalid out-of-band frame")
+    n_buffers, = struct.unpack("<Q", f.read(8))
+    buffers = []
+    for _ in range(n_buffers):
+        nbytes, = struct.unpack("<Q", f.read(8))
+        buffer = bytearray(nbytes)
+        if f.readinto(buffer) != nbytes:
+            raise pickle.UnpicklingError("truncated out-of-band buffer")
+        buffers.append(buffer)
+    return pickle.load(f, buffers=buffers)
+
+
+def pkl_iter(fn: file_type) -> Iterator:
+    """
+    yield the items of the list(s) in a pkl file one by one, only one chunk is in memory at a time
+    """
+    for chunk in pkl_load_chunks(fn):
+        yield from chunk
+
+
 def file_exists(fn: file_type):
     return os.path.isfile(fn) and os.path.getsize(fn) > 0
 
@@ -0,0 +1,186 @@
+from collections import Counter
+from typing import Iterator, Tuple
+
+import numpy as np
+
+from whygreedy.index import chemsys_subsets
+from whygreedy.schema import Compound
+
+"""
+synthetic pairs at the scale of materials project for capacity planning,
+random numbers are drawn in arrays for a chunk of pairs at once,
+products are generated once per chemical system and shared by all pairs containing that chemical system
+"""
+
+MP_OXIDATION_NPAIRS = 39634  # oxidation pairs from stable, oxygen-free compounds
+MP_DECOMPOSITION_NPAIRS = 126335  # one pair per compound in `mp.json.gz`
+
+# elements from H to Bi, excluding oxygen and noble gases
+DEFAULT_ELEMENTS = [
+    "H", "Li", "Be", "B", "C", "N", "F", "Na", "Mg", "Al", "Si", "P", "S", "Cl", "K", "Ca", "Sc", "Ti", "V", "Cr",
+    "Mn", "Fe", "Co", "Ni", "Cu", "Zn", "Ga", "Ge", "As", "Se", "Br", "Rb", "Sr", "Y", "Zr", "Nb", "Mo", "Tc", "Ru",
+    "Rh", "Pd", "Ag", "Cd", "In", "Sn", "Sb", "Te", "I", "Cs", "Ba", "La", "Ce", "Pr", "Nd", "Pm", "Sm", "Eu", "Gd",
+    "Tb", "Dy", "Ho", "Er", "Tm", "Yb", "Lu", "Hf", "Ta", "W", "Re", "Os", "Ir", "Pt", "Au", "Hg", "Tl", "Pb", "Bi",
+]
+
+
+class WorkloadProfile:
+
+    def __init__(
+            self, elements: list[str], element_weights: list[float], nelements_weights: dict[int, float],
+            products_per_chemsys: float, reactant_energy_range: Tuple[float, float] = (-3.0, 0.0),
+            product_energy_range: Tuple[float, float] = (-4.0, -0.5),
+            oxygen_fraction_range: Tuple[float, float] = (0.3, 0.75),
+    ):
+        """
+        :param elements: elements of reactants, oxygen excluded
+        :param element_weights: relative frequency of each element in reactants
+        :param nelements_weights: relative frequency of the number of elements in a reactant
+        :param products_per_chemsys: mean number of products in a chemical system (poisson)
+        :param reactant_energy_range: formation energy per atom of reactants is uniform in this range
+        :param product_energy_range: formation energy per atom of products is uniform in this range
+        :param oxygen_fraction_range: composition of oxygen in an oxide is uniform in this range
+        """
+        assert len(elements) == len(element_weights)
+        assert "O" not in elements
+        self.elements = elements
+        self.element_weights = np.array(element_weights, dtype=float) / sum(element_weights)
+        self.nelements = np.array(sorted(nelements_weights), dtype=int)
+        self.nelements_weights = np.array([nelements_weights[n] for n in self.nelements], dtype=float)
+        self.nelements_weights /= self.nelements_weights.sum()
+        assert self.nelements.min() >= 1 and self.nelements.max() <= len(elements)
+        self.products_per_chemsys = products_per_chemsys
+        self.reactant_energy_range = reactant_energy_range
+        self.product_energy_range = product_energy_range
+        self.oxygen_fraction_range = oxygen_fraction_range
+
+    @classmethod
+    def default(cls):
+        """
+        a rough guess, use `from_pairs` to fit the distributions of real pairs
+        """
+        return cls(
+            elements=DEFAULT_ELEMENTS, element_weights=[1.0, ] * len(DEFAULT_ELEMENTS),
+            nelements_weights={1: 0.02, 2: 0.2, 3: 0.45, 4: 0.27, 5: 0.06},
+            products_per_chemsys=2.0,
+        )
+
+    @classmethod
+    def from_pairs(cls, pairs: list[Tuple[Compound, list[Compound]]], for_oxide: bool):
+        """
+        fit element frequency, number of elements, products per chemical system and energy ranges from pairs
+        """
+        element_counter = Counter()
+        nelements_counter = Counter()
+        chemsys_to_nproducts = dict()
+        reactant_energies = []
+        product_energies = dict()
+        for reactant, products in pairs:
+            element_counter.update(reactant.elements)
+            nelements_counter[len(reactant.elements)] += 1
+            reactant_energies.append(reactant.formation_energy_per_atom)
+            chemsys_counter = Counter()
+            for product in products:
+                chemsys = frozenset(product.elements_exclude_oxygen if for_oxide else product.elements)
+                chemsys_counter[chemsys] += 1
+                product_energies[id(product)] = product.formation_energy_per_atom
+            chemsys_to_nproducts.update(chemsys_counter)
+        element_counter.pop("O", None)
+        elements = sorted(element_counter)
+        product_energies = list(product_energies.values())
+        return cls(
+            elements=elements, element_weights=[element_counter[e] for e in elements],
+            nelements_weights=dict(nelements_counter),
+            products_per_chemsys=float(np.mean(list(chemsys_to_nproducts.values()))),
+            reactant_energy_range=tuple(np.percentile(reactant_energies, [5, 95]).tolist()),
+            product_energy_range=tuple(np.percentile(product_energies, [5, 95]).tolist()),
+        )
+
+
+def gen_synthetic_pairs(
+        n_pairs: int, seed: int, for_oxide: bool, profile: WorkloadProfile = None, chunk_size: int = 10000,
+) -> Iterator[list[Tuple[Compound, list[Compound]]]]:
+    """
+    generate synthetic pairs in chunks, this is meant to be fed to `pkl_dump_chunks`
+
+    :param n_pairs: total number of pairs
+    :param seed: random seed, the same seed gives the same pairs
+    :param for_oxide: if True, products are oxides, otherwise products are competing phases
+    :param profile: distributions of elements, products and energies, default to `WorkloadProfile.default()`
+    :param chunk_size: number of pairs in each chunk
+    :return: an iterator of lists of pairs
+    """
+    if profile is None:
+        profile = WorkloadProfile.default()
+    rng = np.random.default_rng(seed)
+    log_weights = np.log(profile.element_weights)
+    nmax = profile.nelements.max()
+    chemsys_to_products = dict()
+    npairs_generated = 0
+    while npairs_generated < n_pairs:
+        n = min(chunk_size, n_pairs - npairs_generated)
+
+        # reactants, weighted sampling of elements without replacement by the gumbel top-k trick
+        nelements = rng.choice(profile.nelements, size=n, p=profile.nelements_weights)
+        keys = log_weights[np.newaxis, :] + rng.gumbel(size=(n, len(profile.elements)))
+        element_indices = np.argsort(-keys, axis=1)[:, :nmax]
+        mask = np.arange(nmax)[np.newaxis, :] < nelements[:, np.newaxis]
+        compositions = rng.random((n, nmax)) * mask
+        compositions /= compositions.sum(axis=1, keepdims=True)
+        reactant_energies = rng.uniform(*profile.reactant_energy_range, size=n)
+
+        reactant_chemsys = [
+            [profile.elements[j] for j in element_indices[i, :nelements[i]]] for i in range(n)
+        ]
+        new_chemsys = set()
+        for elements in reactant_chemsys:
+            new_chemsys.update(cs for cs in chemsys_subsets(elements) if cs not in chemsys_to_products)
+        chemsys_to_products.update(_gen_chemsys_products(sorted(new_chemsys, key=sorted), rng, profile, for_oxide))
+
+        chunk = []
+        for i, elements in enumerate(reactant_chemsys):
+            reactant = Compound(
+                normalized_formula=dict(zip(elements, compositions[i, :nelements[i]].tolist())),
+                formation_energy_per_atom=float(reactant_energies[i]),
+                mpid="syn-{}-r{}".format(seed, npairs_generated + i),
+            )
+            products = []
+            for cs in chemsys_subsets(elements):
+                products += chemsys_to_products[cs]
+            chunk.append((reactant, products))
+        npairs_generated += n
+        yield chunk
+
+
+def _gen_chemsys_products(chemsys_list: list[frozenset], rng: np.random.Generator, profile: WorkloadProfile,
+                          for_oxide: bool) -> dict[frozenset, list[Compound]]:
+    nproducts = rng.poisson(profile.products_per_chemsys, size=len(chemsys_list))
+    # every element has at least one product so no pair is empty
+    is_unary = np.array([len(cs) == 1 for cs in chemsys_list], dtype=bool)
+    nproducts[is_unary] = np.maximum(nproducts[is_unary], 1)
+    nmax = max([len(cs) for cs in chemsys_list], default=0)
+    ntotal = int(nproducts.sum())
+    compositions = rng.random((ntotal, nmax))
+    energies = rng.uniform(*profile.product_energy_range, size=ntotal)
+    oxygen_fractions = rng.uniform(*profile.oxygen_fraction_range, size=ntotal)
+
+    chemsys_to_products = dict()
+    iproduct = 0
+    for cs, nproduct in zip(chemsys_list, nproducts):
+        elements = sorted(cs)
+        products = []
+        for _ in range(nproduct):
+            composition = compositions[iproduct, :len(elements)]
+            if for_oxide:
+                composition = composition / composition.sum() * (1 - oxygen_fractions[iproduct])
+                formula = dict(zip(elements, composition.tolist()))
+                formula["O"] = float(oxygen_fractions[iproduct])
+            else:
+                formula = dict(zip(elements, (composition / composition.sum()).tolist()))
+            products.append(Compound(
+                normalized_formula=formula, formation_energy_per_atom=float(energies[iproduct]),
+                mpid="syn-{}".format("-".join(elements)) + "-p{}".format(len(products)),
+            ))
+            iproduct += 1
+        chemsys_to_products[cs] = products
+    return chemsys_to_products